@@ -1,21 +1,23 @@
 import asyncio
 from datetime import datetime, timedelta
-from enum import Enum, auto
-from functools import cached_property, partial
-import hashlib
-from math import sqrt
+from enum import IntEnum, auto
+from functools import cached_property, lru_cache, partial
+import itertools
+from math import floor, sqrt
 import re
+import threading
+import time
 from textwrap import dedent, indent
-from typing import Any, Dict, Union
+from typing import Any, Dict, FrozenSet, Iterable, Tuple, Union
 from dataclasses import dataclass
 from importlib import resources
 
 import names
-from thefuzz import process, fuzz
+from rapidfuzz import process, fuzz, utils as fuzz_utils
 from dateutil import parser
 from appdirs import user_data_dir
 from loguru import logger
-from pyrogram import Client, ContinuePropagation
+from pyrogram import Client, ContinuePropagation, filters, raw
 from pyrogram.handlers import MessageHandler, InlineQueryHandler
 from pyrogram.types import (
     BotCommand,
@@ -24,13 +26,14 @@ from pyrogram.types import (
     InputTextMessageContent,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    MessageEntity,
     Message as TM,
     CallbackQuery as TC,
     User as TU,
     InlineQuery as TI,
 )
 from pyrogram.enums import ParseMode, ChatType
-from pyrogram.errors import BadRequest
+from pyrogram.errors import BadRequest, FloodWait, RPCError
 from pyrubrum import (
     DictDatabase,
     Element,
@@ -45,7 +48,7 @@ from pyrubrum import (
 )
 
 from . import __name__, image
-from .utils import Singleton, flatten2, remove_prefix, truncate_str
+from .utils import LRUDict, Singleton, remove_prefix, to_thread, truncate_str
 from .model import (
     Dispute,
     DisputeType,
@@ -63,10 +66,17 @@ from .model import (
     fn,
     SQL,
     JOIN,
+    Value,
+    Case,
 )
 
+UserUserLevel = User.levels.get_through_model()
+UserLevelField = UserLevel.fields.get_through_model()
+LogUser = Log.participants.get_through_model()
+RestrictionField = Restriction.fields.get_through_model()
 
-class ConversationStatus(Enum):
+
+class ConversationStatus(IntEnum):
     WAITING_EXCHANGE = auto()
     WAITING_EXCHANGE_DESC = auto()
     WAITING_TRADE_NAME = auto()
@@ -86,13 +96,18 @@ class ConversationStatus(Enum):
 
 @dataclass
 class Conversation:
+    __slots__ = ("context", "status", "params", "chat_id")
+
     context: Union[TM, TC]
     status: ConversationStatus
     params: Dict[str, Any]
+    chat_id: int
 
 
-@dataclass
+@dataclass(frozen=True)
 class MessageInfo:
+    __slots__ = ("from_user", "trade")
+
     from_user: User
     trade: Trade
 
@@ -103,35 +118,379 @@ def name(self: TU):
 
 setattr(TU, "name", property(name))
 
-fake = {}
 
+def _is_conversation(_, __, message: TM):
+    return bool(message.reply_to_message) or not (message.text and message.text.startswith("/"))
 
-def user_has_field(user: User, field: str):
-    for ur in user.restrictions.where(Restriction.to > datetime.now()):
-        for f in ur.fields:
-            if f.name == "all":
-                return False
-            if f.name == field:
-                return False
-    for ul in user.levels:
-        for f in ul.fields:
-            if f.name == "all":
-                return True
-            if f.name == field:
-                return True
+
+conversation_filter = filters.create(_is_conversation)
+
+
+def _load_first_names(n=128):
+    first_names = []
+    for gender in ("male", "female"):
+        with open(names.FILES[f"first:{gender}"]) as f:
+            first_names.extend(line.split()[0].capitalize() for _, line in zip(range(n), f))
+    return tuple(first_names)
+
+
+_FIRST_NAMES = _load_first_names()
+
+_date_parsers = threading.local()
+
+
+def _parse_date(text: str):
+    # dateutil parser instances are not shared between threads, so each executor thread keeps its own.
+    p = getattr(_date_parsers, "parser", None)
+    if p is None:
+        p = _date_parsers.parser = parser.parser()
+    return p.parse(text)
+
+
+_COINS_PROMPT = dedent(
+    """
+    👉🏼 请输入您的物品的等值价值
+
+    用户可以用硬币购买您的物品, 并扣除 10% 手续费.
+    输入 0 以禁用硬币购买.
+
+    价值参考:
+
+    1     - 群组推荐
+    10    - 网易云会员七天兑换码
+    100   - Emby 邀请码
+    1000  - Telegram 账号
+    10000 - 奥德赛 Emby 邀请码
+    {conv}
+    **请注意**: 请勿设置过高, 若对方认定您的商品虚假, 将导致大量扣信用分.
+    """
+).strip()
+
+_NEW_TRADE_GUIDE = dedent(
+    """
+    🌈 欢迎在 **易物** 置换平台发起交易, 规则如下:
+    1. 禁止发送政治/暴力/虐待/儿童色情/赌博/毒品/非法交易等置换. (永封)
+    2. 禁止将色情图片作为物品描述图. (7天)
+    3. 当您上架的物品出现虚假/货不对板, 并被交换者举报, 我们将扣除您的信用分 (当前为 {sanity}), 低于 90 的信用分将导致您被检查, 低于 70 的信用分将导致您被封禁.
+    4. 在商品描述中加入图片/链接可能需要等待管理员检查才可上架.
+    """
+).strip()
+
+_INDENT = " " * 3
+
+_SYS_INFO_TMPL = "⭐ 当前系统信息:\n\n" + indent(
+    dedent(
+        """
+        有效用户: {users_count}
+        最新用户: [{latest_user.name}](tg://user?id={latest_user.uid})
+        最近访问: [{latest_activity.name}](tg://user?id={latest_activity.uid})
+        总交易数: {trades_count}
+        最新日志: {latest_log}
+        """
+    ).strip(),
+    _INDENT,
+)
+
+_USER_DETAILS_TMPL = "ℹ️ 用户信息如下\n\n" + indent(
+    dedent(
+        """
+        用户 ID: `{uid}`
+        用户昵称: [{user.name}](tg://user?id={user.uid})
+        角色信用: {user.sanity}
+        角色硬币: {user.coins}
+        交易总数: {ts[total]}
+        交易成功: {ts[sold]}
+        交易争议: {ts[disputed]}
+        交换总数: {es[total]}
+        交换成功: {es[accepted]}
+        交换争议: {es[disputed]}
+        最近活跃: {user.activity:%Y-%m-%d}
+        用户组: {levels}
+        """
+    ).strip(),
+    _INDENT,
+)
+
+_USER_ME_TMPL = "ℹ️ 当前用户信息\n\n" + indent(
+    dedent(
+        """
+        ID: `{user.uid}`
+        昵称: [{user.name}](tg://user?id={user.uid})
+        信用: {user.sanity}
+        硬币: {user.coins}
+        交易成功: {ts[sold]} / {ts[total]}
+        交换成功: {es[accepted]} / {es[total]}
+        用户组: {levels}
+        """
+    ).strip(),
+    _INDENT,
+)
+
+_TRADE_NOTIFY_TMPL = (
+    "🙋‍♂️ 新的交易请求\n\n"
+    "对方 ({owner}) 提供了您需要的:\n**{exchange}**\n{description}\n\n"
+    "您需要确认交易以查看内容, 若您点击确认交易, 您的 **{name}** 将被提供给对方.\n"
+)
+
+_URL_RE = re.compile(r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+")
+
+_TRADE_LIST_FIELDS = (Trade.id, Trade.status, Trade.name, Trade.exchange, Trade.deleted)
+_STATUS_ICONS = {
+    TradeStatus.PENDING: "📝",
+    TradeStatus.CHECKING: "🛡️",
+    TradeStatus.LAUNCHED: "🛒",
+    TradeStatus.SOLD: "🤝",
+    TradeStatus.TIMEDOUT: "⌛️",
+    TradeStatus.DISPUTED: "🤔",
+    TradeStatus.VIOLATION: "🚫",
+}
+_DISPUTE_ICONS = {
+    DisputeType.TRADE_NO_GOOD: "🔍",
+    DisputeType.TRADE_NOT_AS_DESCRIPTION: "😞",
+    DisputeType.EXCHANGE_NO_GOOD: "🔍",
+    DisputeType.EXCHANGE_NOT_AS_DESCRIPTION: "😞",
+    DisputeType.VIOLATION: "🚫",
+}
+_DISPUTE_TYPESPEC = {
+    DisputeType.TRADE_NO_GOOD: "出售者发送虚假物品",
+    DisputeType.TRADE_NOT_AS_DESCRIPTION: "出售者发送物品与描述不符",
+    DisputeType.EXCHANGE_NO_GOOD: "交换者发送虚假物品",
+    DisputeType.EXCHANGE_NOT_AS_DESCRIPTION: "交换者发送物品与描述不符",
+    DisputeType.VIOLATION: "违规内容",
+}
+_PUBLIC_STATUS_MSG = {
+    TradeStatus.CHECKING: "🛍️ **需要检查**",
+    TradeStatus.LAUNCHED: "🛍️ 交易详情",
+    TradeStatus.SOLD: "🛍️ 交易成功",
+    TradeStatus.TIMEDOUT: "🛍️ 因**过久未更新**被下架",
+    TradeStatus.DISPUTED: "🛍️ 正处于**纠纷锁定**状态",
+    TradeStatus.VIOLATION: "🛍️ 因**违反用户协议**被移除",
+}
+_MINE_STATUS_MSG = {
+    TradeStatus.PENDING: "**未发布**",
+    TradeStatus.CHECKING: "正在检查**待上架**",
+    TradeStatus.LAUNCHED: "**已上架**",
+    TradeStatus.SOLD: "交易成功",
+    TradeStatus.TIMEDOUT: "因**过久未更新**被下架",
+    TradeStatus.DISPUTED: "正处于**纠纷锁定**状态",
+    TradeStatus.VIOLATION: "因**违反用户协议**被移除",
+}
+
+BROADCAST_CONCURRENCY = 20
+BROADCAST_EDIT_INTERVAL = 2.0
+
+LOG_FLUSH_INTERVAL = 0.1
+LOG_BATCH_SIZE = 100
+
+TRADE_CACHE_TTL = 2.0
+TG_USER_CACHE_TTL = 300
+PERM_CACHE_TTL = 20
+_perm_cache: Dict[str, Tuple[float, FrozenSet[str], FrozenSet[str]]] = LRUDict(maxsize=4096)
+_level_names_cache: Dict[str, str] = LRUDict(maxsize=4096)
+
+
+def invalidate_user_field(user: User = None):
+    if user:
+        _perm_cache.pop(str(user.uid), None)
+        _level_names_cache.pop(str(user.uid), None)
     else:
+        _perm_cache.clear()
+        _level_names_cache.clear()
+
+
+def user_has_field(user: User, field: str):
+    entry = _perm_cache.get(str(user.uid), None)
+    if not entry or entry[0] <= time.monotonic():
+        entry = (time.monotonic() + PERM_CACHE_TTL, *_user_fields(user))
+        _perm_cache[str(user.uid)] = entry
+    _, grants, denies = entry
+    if "all" in denies or field in denies:
         return False
+    return "all" in grants or field in grants
+
+
+def user_level_names(user: User):
+    names = _level_names_cache.get(str(user.uid), None)
+    if names is None:
+        names = ", ".join([name for name, in user.levels.select(UserLevel.name).tuples()])
+        _level_names_cache[str(user.uid)] = names
+    return names
+
+
+def _user_fields(user: User):
+    grants = (
+        Field.select(Field.name, Value(True).alias("allow"))
+        .join(UserLevelField)
+        .join(UserLevel)
+        .join(UserUserLevel)
+        .where(UserUserLevel.user == user)
+    )
+    denies = (
+        Field.select(Field.name, Value(False).alias("allow"))
+        .join(RestrictionField)
+        .join(Restriction)
+        .where(Restriction.user == user, Restriction.to > datetime.now())
+    )
+    allowed, denied = set(), set()
+    for name, allow in (grants | denies).tuples():
+        (allowed if allow else denied).add(name)
+    return frozenset(allowed), frozenset(denied)
 
 
 def user_spec(user: User):
     if user.anonymous:
-        if user.uid not in fake:
-            fake[user.uid] = names.get_first_name()
-        return fake[user.uid]
+        return _FIRST_NAMES[int(user.uid) % len(_FIRST_NAMES)]
     else:
         return user.name
 
 
+def _in_connection(func, *args, **kw):
+    with db.connection_context():
+        return func(*args, **kw)
+
+
+async def db_thread(func, *args, **kw):
+    return await to_thread(_in_connection, func, *args, **kw)
+
+
+def over_launch_limit(user: User, limit: int = 5):
+    launched = Trade.select(Trade.id).where(
+        Trade.user == user, Trade.status == TradeStatus.LAUNCHED, Trade.deleted == False
+    )
+    return launched.limit(limit + 1).count() > limit
+
+
+def adjust_user(user: User, sanity: float = 0, coins: float = 0):
+    sanity, coins = floor(sanity), floor(coins)
+    User.update(sanity=fn.MAX(fn.MIN(User.sanity + sanity, 100), 0), coins=User.coins + coins).where(
+        User.id == user.id
+    ).execute()
+    user.sanity = max(min(user.sanity + sanity, 100), 0)
+    user.coins += coins
+
+
+def _count_if(cond):
+    return fn.COALESCE(fn.SUM(Case(None, [(cond, 1)], 0)), 0)
+
+
+def user_trade_stats(user: User):
+    return (
+        Trade.select(
+            _count_if((Trade.status > TradeStatus.PENDING) & (Trade.deleted == False)).alias("total"),
+            _count_if(Trade.status == TradeStatus.SOLD).alias("sold"),
+            _count_if(Trade.status >= TradeStatus.DISPUTED).alias("disputed"),
+        )
+        .where(Trade.user == user)
+        .dicts()
+        .get()
+    )
+
+
+def user_exchange_stats(user: User):
+    return (
+        Exchange.select(
+            fn.COUNT(Exchange.id).alias("total"),
+            _count_if(Exchange.status == ExchangeStatus.ACCEPTED).alias("accepted"),
+            _count_if(Exchange.status >= ExchangeStatus.DISPUTED).alias("disputed"),
+        )
+        .where(Exchange.user == user)
+        .dicts()
+        .get()
+    )
+
+
+def user_restrictions(user: User, now: datetime):
+    by = User.alias()
+    restrictions = list(
+        Restriction.select(Restriction, by)
+        .join(by, on=(Restriction.by == by.id))
+        .where(Restriction.user == user)
+        .order_by(Restriction.to.desc())
+    )
+    fields = {r.id: [] for r in restrictions}
+    active = [r.id for r in restrictions if r.to > now]
+    if active:
+        for rid, name in (
+            Field.select(RestrictionField.restriction, Field.name)
+            .join(RestrictionField)
+            .where(RestrictionField.restriction.in_(active))
+            .order_by(RestrictionField.id)
+            .tuples()
+        ):
+            fields[rid].append(name)
+    return [(r, fields[r.id]) for r in restrictions]
+
+
+@lru_cache(maxsize=1024)
+def contains_url(*texts: str):
+    return bool(_URL_RE.search(" ".join(filter(None, texts))))
+
+
+def system_users_count():
+    return (
+        UserUserLevel.select(fn.COUNT(UserUserLevel.user.distinct()))
+        .join(UserLevel)
+        .where(UserLevel.name == "system")
+        .scalar()
+    )
+
+
+@lru_cache(maxsize=None)
+def field_by_name(name: str):
+    return Field.get(name=name)
+
+
+@lru_cache(maxsize=None)
+def field_by_id(fid: int):
+    return Field.get_by_id(fid)
+
+
+def invalidate_fields():
+    field_by_name.cache_clear()
+    field_by_id.cache_clear()
+
+
+def assigned_fields():
+    return (
+        Field.select(Field.id, Field.name)
+        .where(Field.id.in_(UserLevelField.select(UserLevelField.field)))
+        .order_by(Field.id)
+        .namedtuples()
+    )
+
+
+def levels_with_field_count(*where):
+    query = (
+        UserLevel.select(UserLevel, fn.COUNT(UserLevelField.id).alias("field_count"))
+        .join(UserLevelField, JOIN.LEFT_OUTER, on=(UserLevelField.userlevel == UserLevel.id))
+        .group_by(UserLevel)
+    )
+    if where:
+        query = query.where(*where)
+    return query.namedtuples()
+
+
+def accepted_exchange(t: Trade):
+    return (
+        Exchange.select(Exchange, User)
+        .join(User)
+        .where(Exchange.trade == t.id, Exchange.status == ExchangeStatus.ACCEPTED)
+        .get()
+    )
+
+
+def get_trade_with_user(tid: int):
+    return Trade.select(Trade, User).join(User).where(Trade.id == tid).get()
+
+
+def get_exchange_with_user(eid: int):
+    return Exchange.select(Exchange, User).join(User).where(Exchange.id == eid).get()
+
+
+def get_dispute_with_user(did: int):
+    return Dispute.select(Dispute, User).join(User).where(Dispute.id == did).get()
+
+
 def useroper(field: str = None, conversation=False, group=False):
     def deco(func):
         async def wrapper(*args, **kw):
@@ -185,6 +544,227 @@ def useroper(field: str = None, conversation=False, group=False):
     return deco
 
 
+@dataclass(frozen=True)
+class _Method:
+    name: str
+
+
+class _MenuSpec:
+    def __init__(self, cls, *args, **kw):
+        self.cls = cls
+        self.args = args
+        self.kw = kw
+
+    def bind(self, bot: "Bot"):
+        resolve = lambda v: getattr(bot, v.name) if isinstance(v, _Method) else v
+        return self.cls(*[resolve(a) for a in self.args], **{k: resolve(v) for k, v in self.kw.items()})
+
+
+def _bind_menu(tree, bot: "Bot"):
+    if isinstance(tree, dict):
+        return {m.bind(bot): _bind_menu(c, bot) for m, c in tree.items()}
+    elif isinstance(tree, (set, list)):
+        return type(tree)(m.bind(bot) for m in tree)
+    else:
+        return tree
+
+
+def _ms(**kw):
+    return {"parse_mode": ParseMode.MARKDOWN, "style": MenuStyle(back_text="◀️ 返回", **kw)}
+
+
+def _ps(**kw):
+    return {
+        "parse_mode": ParseMode.MARKDOWN,
+        "style": PageStyle(back_text="◀️ 返回", previous_page_text="⬅️", next_page_text="➡️", **kw),
+    }
+
+
+_Menu = partial(_MenuSpec, Menu)
+_DMenu = partial(_MenuSpec, Menu, **_ms())
+_DDMenu = partial(_MenuSpec, Menu, **_ms(back_enable=False))
+_TMenu = partial(_MenuSpec, Menu, **_ms(back_to="trade_list"))
+_PageMenu = partial(_MenuSpec, PageMenu)
+_ContentPageMenu = partial(_MenuSpec, ContentPageMenu)
+
+_MENU_SKELETON = {
+    _DMenu("Start", "start", _Method("on_start"), default=True): {
+        _ContentPageMenu(
+            "🛍️ 交易大厅",
+            "trade_list",
+            _Method("content_trade_list"),
+            header=_Method("header_trade_list"),
+            footer="👇 您可以直接输入以进行搜索",
+            **_ps(
+                limit=5,
+                limit_items=10,
+                back_enable=False,
+                extras=["__new_trade_guide", "__trade_list_switch"],
+            ),
+        ): {_DMenu("💲 交易详情", "trade_details", _Method("on_trade_details"))},
+        _DMenu("👤 我的信息", "user_me", _Method("on_user_me")): {
+            _DMenu("💬 开关私聊", "switch_contact", _Method("on_switch_contact")),
+            _DMenu("🕵️‍♂️ 开关匿名", "switch_anonymous", _Method("on_switch_anonymous")),
+        },
+    },
+    _DMenu("Admin", "admin", _Method("on_admin")): {
+        _DMenu("👤 用户管理", "user_admin", _Method("on_user_admin")): {
+            _ContentPageMenu(
+                "👥 列出用户",
+                "users_list",
+                _Method("content_users_list"),
+                header="👇 请按序号选择您需要查询的用户信息:\n",
+                **_ps(limit=5, limit_items=10, extras=["__users_message"]),
+            ): {
+                _DMenu("用户详情", "user", _Method("on_user_details"), disable_web_page_preview=True): {
+                    _ContentPageMenu(
+                        "👑 调整用户组",
+                        "user_level",
+                        _Method("content_user_level"),
+                        header="👇🏼 请选择用户隶属的用户组以删除:",
+                        **_ps(limit=3, limit_items=6, extras=["__user_level_add"]),
+                    ): {_DMenu("删除用户组", "user_level_delete", _Method("on_user_level_delete"))},
+                    _DMenu("⚠️ 永久封禁", "user_delete", _Method("on_user_delete")): {
+                        _DMenu("✅ 确认", "user_delete_confirm", _Method("on_user_delete_confirm"))
+                    },
+                    _ContentPageMenu(
+                        "🔨 设置限制",
+                        "user_restriction_set",
+                        _Method("content_restriction_fields"),
+                        header="👇🏼 请选择限制用户权限:",
+                        footer=_Method("footer_restriction_fields"),
+                        **_ps(limit=3, limit_items=6, extras=["__user_restriction"]),
+                    ): {_DMenu("接收限制", "user_restriction_get", _Method("on_user_restriction_get"))},
+                    _DMenu(
+                        "✅ 移除所有封禁", "user_restriction_delete", _Method("on_user_restriction_delete")
+                    ): None,
+                    _DMenu("✉️ 发送消息", "user_message", _Method("on_user_message")): None,
+                },
+            },
+            _ContentPageMenu(
+                "👥 用户组管理",
+                "level_admin",
+                _Method("content_level_admin"),
+                header="👇🏼 请选择用户组:",
+                **_ps(limit=10, limit_items=5, back_to="user_admin"),
+            ): {
+                _ContentPageMenu(
+                    "接收用户组",
+                    "level",
+                    _Method("content_level_field"),
+                    header="👇🏼 请选择权限以删除:",
+                    **_ps(limit=5, limit_items=10, extras=["__level_field_add"]),
+                ): {_DMenu("删除权限", "user_level_field", _Method("on_level_field_delete"))}
+            },
+        },
+        _DMenu("ℹ️ 系统信息", "sys_admin", _Method("on_sys_admin")): None,
+    },
+    _Menu("✉️ 向所有人发信", "__users_message", _Method("on_user_message"), **_ms(back_to="users_list")): None,
+    _TMenu("🆕️ 新建交易", "__new_trade_guide", _Method("on_new_trade_guide")): {
+        _TMenu("✅ 确认并同意", "new_trade", _Method("on_new_trade"))
+    },
+    _DMenu("💰 我的交易", "__trade_list_switch", _Method("on_trade_list_switch")): None,
+    _DMenu("交易提醒", "__trade_notify", _Method("on_trade_notify")): {
+        _DMenu("交易确认", "trade_accept", _Method("on_trade_accept")),
+        _DMenu("交易拒绝", "trade_decline", _Method("on_trade_decline")),
+        _DMenu("拉黑此人", "trade_blacklist", _Method("on_trade_blacklist")),
+    },
+    _DMenu("交易完成", "__trade_finished", _Method("on_trade_finish")): {
+        _PageMenu(
+            "⚠️ 举报交易",
+            "report_after_trade",
+            "🚔 您认为对方的物品存在以下哪种问题?",
+            [Element("未收到货", "no_good"), Element("货不对板", "not_as_description")],
+            **_ps(limit=2, limit_items=2),
+        ): {_DMenu("接收问题", "report_after_trade_problem", _Method("on_trade_report"))},
+        _DMenu("💬 在线咨询", "contact_after_trade", _Method("on_contact")): None,
+    },
+    _DMenu("增加描述", "__exchange_add_desc", _Method("on_exchange_add_desc")): {
+        _DDMenu("不添加", "exchange_no_desc", _Method("on_exchange_no_desc"))
+    },
+    _DMenu("交换提交成功", "__exchange_submitted", _Method("on_exchange_submitted")): None,
+    _DMenu("增加描述", "__trade_add_desc", _Method("on_trade_add_desc")): {
+        _DDMenu("不添加", "trade_no_desc", _Method("on_trade_no_desc"))
+    },
+    _DMenu("增加图片", "__trade_add_photo", _Method("on_trade_add_photo")): {
+        _DDMenu("不添加", "trade_no_photo", _Method("on_trade_no_photo"))
+    },
+    _DMenu("设定开始时间", "__trade_set_start_time", _Method("on_set_trade_start_time")): {
+        _DDMenu("不设定", "trade_no_start_time", _Method("on_trade_no_start_time"))
+    },
+    _PageMenu(
+        "设定二次确认",
+        "__trade_set_revision",
+        "🚔 对方提供交换物后, 您是否需要检查对方用户和物品描述?\n💡 **无需** 时才能支持硬币购买",
+        [Element("需要", "yes"), Element("无需", "no")],
+        **_ps(limit=2, limit_items=2),
+    ): {_DDMenu("接收二次确认", "trade_revision", _Method("on_trade_revision"))},
+    _TMenu("交易详情公共", "__trade_public", _Method("on_trade_details_public")): {
+        _DMenu("💲 进行交易", "exchange_public", "💲 请选择您的交易方式:"): {
+            _DMenu("💲 以物易物", "exchange_public_item", _Method("on_exchange")),
+            _DMenu("💲 使用硬币", "exchange_public_coin", _Method("on_exchange_coin")),
+        },
+        _DMenu("⚠️ 举报交易", "report_public", _Method("on_report")): None,
+        _DMenu("💬 在线咨询", "contact_public", _Method("on_contact")): None,
+    },
+    _TMenu("交易详情管理", "__trade_admin", _Method("on_trade_details_public")): {
+        _DMenu("💲 进行交易", "exchange_admin", "💲 请选择您的交易方式:"): {
+            _DMenu("💲 以物易物", "exchange_admin_item", _Method("on_exchange")),
+            _DMenu("💲 使用硬币", "exchange_admin_coin", _Method("on_exchange_coin")),
+        },
+        _DMenu("💬 在线咨询", "contact_admin", _Method("on_contact")): None,
+        _DMenu("✅ 审核通过", "checked_admin", _Method("on_checked")): None,
+        _ContentPageMenu(
+            "⚠️ 举报管理",
+            "report_admin",
+            _Method("content_report_admin"),
+            header="👇🏼 请选择举报信息以查看:",
+            **_ps(limit=4, limit_items=4),
+        ): {
+            _DMenu("举报详情", "report_details", _Method("on_report_details")): {
+                _DMenu("✅ 同意", "report_accept", _Method("on_report_accept")),
+                _DMenu("⚠️ 拒绝", "report_decline", _Method("on_report_decline")),
+            }
+        },
+        _DMenu("🚫 立刻删除", "violation", _Method("on_violation")): None,
+    },
+    _TMenu("交易详情我的", "__trade_mine", _Method("on_trade_details_mine")): {
+        _DMenu("▶️ 上架下架", "launch", _Method("on_launch")): None,
+        _DMenu("🚮 删除交易", "delete", _Method("on_delete")): None,
+        _DMenu("🔄 编辑交易", "modify", _Method("on_modify")): None,
+        _DMenu("🔗 分享交易", "share", _Method("on_share")): None,
+        _ContentPageMenu(
+            "📩 交换请求",
+            "trade_exchange_list",
+            _Method("content_trade_exchange_list"),
+            header="👇 请按序号选择您需要查询的交换请求:\n",
+            **_ps(limit=3, limit_items=6),
+        ): {_DMenu("接收交换请求", "trade_exchange", _Method("on_trade_exchange"))},
+    },
+    _ContentPageMenu(
+        "➕ 增加用户组",
+        "__user_level_add",
+        _Method("content_user_level_add"),
+        header="👇🏼 请选择用户组以添加:",
+        **_ps(limit=5, limit_items=10, back_to="user"),
+    ): {_DMenu("添加用户组", "user_level_add", _Method("on_user_level_add"))},
+    _PageMenu(
+        "✅ 确认",
+        "__user_restriction",
+        _Method("on_user_restriction_ok"),
+        [Element(str(h), str(h)) for h in [1, 3, 7, 30, 360]],
+        **_ps(limit=5, limit_items=5, back_to="user"),
+    ): {_DMenu("接收时长", "user_restriction_time", _Method("on_user_restriction"))},
+    _ContentPageMenu(
+        "➕ 增加权限",
+        "__level_field_add",
+        _Method("content_level_field_add"),
+        header="👇🏼 请选择权限以添加, 或输入以手动添加:",
+        **_ps(limit=5, limit_items=10),
+    ): {_DMenu("添加权限", "level_field_add", _Method("on_level_field_add"))},
+}
+
+
 class Bot(metaclass=Singleton):
     username = "iwexchanger_bot"
     groupname = "iwexchanger_bot_files"
@@ -201,9 +781,40 @@ class Bot(metaclass=Singleton):
         self.started = asyncio.Event()
         self.proxy = proxy
 
-        self._user_conversion: Dict[int, Conversation] = {}
-        self._user_messages: Dict[int, MessageInfo] = {}
+        self._user_conversion: Dict[str, Conversation] = {}
+        self._user_messages: Dict[int, MessageInfo] = LRUDict(maxsize=20000)
+        self._trade_cache: Dict[int, Tuple[float, Trade]] = LRUDict(maxsize=1024)
+        self._exchange_cache: Dict[int, Tuple[float, Exchange]] = LRUDict(maxsize=4096)
+        self._tg_user_cache: Dict[str, Tuple[float, TU]] = LRUDict(maxsize=4096)
         self._logo = None
+        self._system_user = None
+        self._system_bootstrapped = False
+        self._name_index: Dict[str, str] = {}
+        self._cid_counter = itertools.count(1)
+        self._log_queue = asyncio.Queue()
+        self._log_task = None
+        self._delete_queue = asyncio.Queue()
+        self._delete_task = None
+        self._conv_text_handlers = {
+            ConversationStatus.WAITING_REPORT: self._handle_waiting_report,
+            ConversationStatus.WAITING_EXCHANGE: self._handle_waiting_exchange,
+            ConversationStatus.WAITING_EXCHANGE_DESC: self._handle_waiting_exchange_desc,
+            ConversationStatus.WAITING_TRADE_NAME: self._handle_waiting_trade_name,
+            ConversationStatus.WAITING_TRADE_DESC: self._handle_waiting_trade_desc,
+            ConversationStatus.WAITING_TRADE_GOOD: self._handle_waiting_trade_good,
+            ConversationStatus.WAITING_EXCHANGE_FOR: self._handle_waiting_exchange_for,
+            ConversationStatus.WAITING_COINS: self._handle_waiting_coins,
+            ConversationStatus.WAITING_TRADE_START_TIME: self._handle_waiting_trade_start_time,
+            ConversationStatus.WAITING_USER: self._handle_waiting_user,
+            ConversationStatus.WAITING_MESSAGE: self._handle_waiting_message,
+            ConversationStatus.WAITING_FIELD: self._handle_waiting_field,
+            ConversationStatus.WAITING_SEARCH_TRADE: self._handle_waiting_search_trade,
+            ConversationStatus.CHATING: self._handle_chating,
+        }
+        self._conv_photo_handlers = {
+            ConversationStatus.WAITING_REPORT: self._handle_waiting_report,
+            ConversationStatus.WAITING_TRADE_PHOTO: self._handle_waiting_trade_photo,
+        }
 
     async def listen(self):
         try:
@@ -216,12 +827,22 @@ class Bot(metaclass=Singleton):
                 await self.bot.stop()
             except ConnectionError:
                 pass
+            if self._log_task:
+                self._log_task.cancel()
+            if self._delete_task:
+                self._delete_task.cancel()
+            self._write_logs(self._pop_logs())
 
     async def setup(self):
-        self.bot.add_handler(MessageHandler(self.text_handler))
+        self.bot.add_handler(MessageHandler(self.text_handler, conversation_filter))
         self.bot.add_handler(InlineQueryHandler(self.inline_handler))
+        self._log_task = asyncio.create_task(self._drain_logs())
+        self._delete_task = asyncio.create_task(self._drain_deletes())
         self.menu = ParameterizedHandler(self.tree, DictDatabase())
         self.menu.setup(self.bot)
+        self._name_index = {u.uid: u.name for u in User.select(User.uid, User.name).iterator()}
+        self._system_user = User.get(uid="0")
+        self._system_bootstrapped = system_users_count() >= 2
         with resources.path(image, "logo.png") as f:
             message = await self.bot.send_photo(self.groupname, str(f))
         self._logo = message.photo.file_id
@@ -237,22 +858,71 @@ class Bot(metaclass=Singleton):
         **kw,
     ):
         message = context.message if isinstance(context, TC) else context
-        current_conv = self._user_conversion.get((message.chat.id, user.uid), None)
+        current_conv = self._user_conversion.get(str(user.uid), None)
         current_params = current_conv.params if current_conv else {}
         params = params or current_params
         params.update(kw)
-        self._user_conversion[(message.chat.id, user.uid)] = (
-            Conversation(context, status, params) if status else None
+        self._user_conversion[str(user.uid)] = (
+            Conversation(context, status, params, message.chat.id) if status else None
         )
 
+    def add_log(self, initiator: User, activity: str, details: str = None, participants: Iterable[User] = ()):
+        self._log_queue.put_nowait(
+            (initiator.id, activity, details, datetime.now(), [p.id for p in participants])
+        )
+
+    def _pop_logs(self, limit: int = None):
+        logs = []
+        while not self._log_queue.empty() and (limit is None or len(logs) < limit):
+            logs.append(self._log_queue.get_nowait())
+        return logs
+
+    def _write_logs(self, logs):
+        if not logs:
+            return
+        participants = []
+        try:
+            with db.atomic():
+                for initiator, activity, details, created, pids in logs:
+                    lid = Log.insert(
+                        initiator=initiator, activity=activity, details=details, created=created
+                    ).execute()
+                    participants.extend({LogUser.log: lid, LogUser.user: pid} for pid in pids)
+                if participants:
+                    LogUser.insert_many(participants).execute()
+        except Exception as e:
+            logger.opt(exception=e).warning(f"写入 {len(logs)} 条日志时出现错误.")
+
+    async def _drain_logs(self):
+        while True:
+            logs = [await self._log_queue.get()]
+            try:
+                await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            except asyncio.CancelledError:
+                self._write_logs(logs + self._pop_logs())
+                raise
+            await db_thread(self._write_logs, logs + self._pop_logs(limit=LOG_BATCH_SIZE - 1))
+
+    def delete_later(self, message: TM, delay: float = 0.5):
+        self._delete_queue.put_nowait((time.monotonic() + delay, message))
+
+    async def _drain_deletes(self):
+        while True:
+            when, message = await self._delete_queue.get()
+            await asyncio.sleep(when - time.monotonic())
+            try:
+                await message.delete()
+            except Exception as e:
+                logger.opt(exception=e).debug("删除消息时出现错误.")
+
     async def to_menu(self, client: Client, context: Union[TC, TM] = None, menu_id="start", uid=None, **kw):
         if not context:
             if not uid:
                 raise ValueError("uid must be provided for context constructing")
-            message = await client.send_message(uid, "🔄 正在加载")
-            user = await client.get_users(uid)
-            hash = hashlib.sha1(f"{uid}_{datetime.now().timestamp()}".encode())
-            cid = str(int(hash.hexdigest(), 16) % (10**8))
+            message, user = await asyncio.gather(
+                client.send_message(uid, "🔄 正在加载"), self.get_tg_user(client, uid)
+            )
+            cid = str(next(self._cid_counter) % (10**8))
             context = TC(client=client, id=cid, from_user=user, message=message, chat_instance=None)
         if isinstance(context, TC):
             params = getattr(context, "parameters", {})
@@ -261,227 +931,73 @@ class Bot(metaclass=Singleton):
             params = kw
         await self.menu[menu_id].on_update(self.menu, client, context, params)
 
-    async def fetch_user(self, u: Union[TU, str, int]):
-        if isinstance(u, TU):
-            user = u
-            uid = u.id
-        else:
-            user = await self.bot.get_users(u)
-            uid = u
-        system = User.get(uid="0")
+    def _get_or_create_user(self, uid, name):
+        ur = User.get_or_none(uid=uid)
+        if ur:
+            return ur, None
         with db.atomic():
-            ur, created = User.get_or_create(uid=uid, defaults={"name": user.name})
+            ur, created = User.get_or_create(uid=uid, defaults={"name": name})
             if created:
-                user_info = f"uid = {uid}"
-                if user.username:
-                    user_info = f"{user.username}, {user_info}"
-                log = Log.create(initiator=system, activity="create user", details=str(uid))
-                log.participants.add(ur)
-                logger.info(f"新用户: {user.name} [gray50]({user_info})[/].")
                 lr, _ = UserLevel.get_or_create(name="user")
                 ur.levels.add(lr)
-                log = Log.create(initiator=system, activity="add level to user", details=str(lr.id))
-                log.participants.add(ur)
-        UserUserLevel = User.levels.get_through_model()
-        system_users = (
-            UserLevel.select().where(UserLevel.name == "system").join(UserUserLevel).join(User).group_by(User)
-        )
-        if system_users.count() < 2:
-            with db.atomic():
+                return ur, lr
+        return ur, None
+
+    def _bootstrap_system_user(self, ur):
+        with db.atomic():
+            if system_users_count() < 2:
                 lr, _ = UserLevel.get_or_create(name="system")
                 ur.levels.add(lr)
-                log = Log.create(initiator=system, activity="add level to user", details=str(lr.id))
-                log.participants.add(ur)
+                return lr
+
+    async def get_tg_user(self, client: Client, uid: Union[str, int]):
+        now = time.monotonic()
+        cached = self._tg_user_cache.get(str(uid))
+        if cached and now - cached[0] < TG_USER_CACHE_TTL:
+            return cached[1]
+        user = await client.get_users(uid)
+        self._tg_user_cache[str(uid)] = (now, user)
+        return user
+
+    async def fetch_user(self, u: Union[TU, str, int]):
+        if isinstance(u, TU):
+            user = u
+            uid = u.id
+            self._tg_user_cache[str(uid)] = (time.monotonic(), user)
+        else:
+            user = await self.get_tg_user(self.bot, u)
+            uid = u
+        if not self._system_user:
+            self._system_user = User.get(uid="0")
+        system = self._system_user
+        ur, lr = await db_thread(self._get_or_create_user, uid, user.name)
+        created = bool(lr)
+        if created:
+            user_info = f"uid = {uid}"
+            if user.username:
+                user_info = f"{user.username}, {user_info}"
+            self.add_log(system, "create user", str(uid), [ur])
+            logger.info(f"新用户: {user.name} [gray50]({user_info})[/].")
+            self._name_index[str(uid)] = user.name
+            invalidate_user_field(ur)
+            self.add_log(system, "add level to user", str(lr.id), [ur])
+        elif ur.name != user.name:
+            ur.name = user.name
+            await db_thread(ur.save, only=[User.name])
+            self._name_index[str(uid)] = user.name
+            self.add_log(ur, "updated username")
+        if not self._system_bootstrapped:
+            lr = await db_thread(self._bootstrap_system_user, ur)
+            if lr:
+                invalidate_user_field(ur)
+                self.add_log(system, "add level to user", str(lr.id), [ur])
                 logger.info(f"[red]用户 {user.name} 已被设为 SYSTEM[/].")
+            self._system_bootstrapped = True
         return ur, created
 
     @cached_property
     def tree(self):
-        ms = lambda **kw: {"parse_mode": ParseMode.MARKDOWN, "style": MenuStyle(back_text="◀️ 返回", **kw)}
-        ps = lambda **kw: {
-            "parse_mode": ParseMode.MARKDOWN,
-            "style": PageStyle(back_text="◀️ 返回", previous_page_text="⬅️", next_page_text="➡️", **kw),
-        }
-        DMenu = partial(Menu, **ms())
-        DDMenu = partial(Menu, **ms(back_enable=False))
-        return transform(
-            {
-                DMenu("Start", "start", self.on_start, default=True): {
-                    ContentPageMenu(
-                        "🛍️ 交易大厅",
-                        "trade_list",
-                        self.content_trade_list,
-                        header=self.header_trade_list,
-                        footer="👇 您可以直接输入以进行搜索",
-                        **ps(
-                            limit=5,
-                            limit_items=10,
-                            back_enable=False,
-                            extras=["__new_trade_guide", "__trade_list_switch"],
-                        ),
-                    ): {DMenu("💲 交易详情", "trade_details", self.on_trade_details)},
-                    DMenu("👤 我的信息", "user_me", self.on_user_me): {
-                        DMenu("💬 开关私聊", "switch_contact", self.on_switch_contact),
-                        DMenu("🕵️‍♂️ 开关匿名", "switch_anonymous", self.on_switch_anonymous),
-                    },
-                },
-                DMenu("Admin", "admin", self.on_admin): {
-                    DMenu("👤 用户管理", "user_admin", self.on_user_admin): {
-                        ContentPageMenu(
-                            "👥 列出用户",
-                            "users_list",
-                            self.content_users_list,
-                            header="👇 请按序号选择您需要查询的用户信息:\n",
-                            **ps(limit=5, limit_items=10, extras=["__users_message"]),
-                        ): {
-                            DMenu("用户详情", "user", self.on_user_details, disable_web_page_preview=True): {
-                                ContentPageMenu(
-                                    "👑 调整用户组",
-                                    "user_level",
-                                    self.content_user_level,
-                                    header="👇🏼 请选择用户隶属的用户组以删除:",
-                                    **ps(limit=3, limit_items=6, extras=["__user_level_add"]),
-                                ): {DMenu("删除用户组", "user_level_delete", self.on_user_level_delete)},
-                                DMenu("⚠️ 永久封禁", "user_delete", self.on_user_delete): {
-                                    DMenu("✅ 确认", "user_delete_confirm", self.on_user_delete_confirm)
-                                },
-                                ContentPageMenu(
-                                    "🔨 设置限制",
-                                    "user_restriction_set",
-                                    self.content_restriction_fields,
-                                    header="👇🏼 请选择限制用户权限:",
-                                    footer=self.footer_restriction_fields,
-                                    **ps(limit=3, limit_items=6, extras=["__user_restriction"]),
-                                ): {DMenu("接收限制", "user_restriction_get", self.on_user_restriction_get)},
-                                DMenu(
-                                    "✅ 移除所有封禁", "user_restriction_delete", self.on_user_restriction_delete
-                                ): None,
-                                DMenu("✉️ 发送消息", "user_message", self.on_user_message): None,
-                            },
-                        },
-                        ContentPageMenu(
-                            "👥 用户组管理",
-                            "level_admin",
-                            self.content_level_admin,
-                            header="👇🏼 请选择用户组:",
-                            **ps(limit=10, limit_items=5, back_to="user_admin"),
-                        ): {
-                            ContentPageMenu(
-                                "接收用户组",
-                                "level",
-                                self.content_level_field,
-                                header="👇🏼 请选择权限以删除:",
-                                **ps(limit=5, limit_items=10, extras=["__level_field_add"]),
-                            ): {DMenu("删除权限", "user_level_field", self.on_level_field_delete)}
-                        },
-                    },
-                    DMenu("ℹ️ 系统信息", "sys_admin", self.on_sys_admin): None,
-                },
-                Menu("✉️ 向所有人发信", "__users_message", self.on_user_message, **ms(back_to="users_list")): None,
-                Menu("🆕️ 新建交易", "__new_trade_guide", self.on_new_trade_guide, **ms(back_to="trade_list")): {
-                    Menu("✅ 确认并同意", "new_trade", self.on_new_trade, **ms(back_to="trade_list"))
-                },
-                DMenu("💰 我的交易", "__trade_list_switch", self.on_trade_list_switch): None,
-                DMenu("交易提醒", "__trade_notify", self.on_trade_notify): {
-                    DMenu("交易确认", "trade_accept", self.on_trade_accept),
-                    DMenu("交易拒绝", "trade_decline", self.on_trade_decline),
-                    DMenu("拉黑此人", "trade_blacklist", self.on_trade_blacklist),
-                },
-                DMenu("交易完成", "__trade_finished", self.on_trade_finish): {
-                    PageMenu(
-                        "⚠️ 举报交易",
-                        "report_after_trade",
-                        "🚔 您认为对方的物品存在以下哪种问题?",
-                        [Element("未收到货", "no_good"), Element("货不对板", "not_as_description")],
-                        **ps(limit=2, limit_items=2),
-                    ): {DMenu("接收问题", "report_after_trade_problem", self.on_trade_report)},
-                    DMenu("💬 在线咨询", "contact_after_trade", self.on_contact): None,
-                },
-                DMenu("增加描述", "__exchange_add_desc", self.on_exchange_add_desc): {
-                    DDMenu("不添加", "exchange_no_desc", self.on_exchange_no_desc)
-                },
-                DMenu("交换提交成功", "__exchange_submitted", self.on_exchange_submitted): None,
-                DMenu("增加描述", "__trade_add_desc", self.on_trade_add_desc): {
-                    DDMenu("不添加", "trade_no_desc", self.on_trade_no_desc)
-                },
-                DMenu("增加图片", "__trade_add_photo", self.on_trade_add_photo): {
-                    DDMenu("不添加", "trade_no_photo", self.on_trade_no_photo)
-                },
-                DMenu("设定开始时间", "__trade_set_start_time", self.on_set_trade_start_time): {
-                    DDMenu("不设定", "trade_no_start_time", self.on_trade_no_start_time)
-                },
-                PageMenu(
-                    "设定二次确认",
-                    "__trade_set_revision",
-                    "🚔 对方提供交换物后, 您是否需要检查对方用户和物品描述?\n💡 **无需** 时才能支持硬币购买",
-                    [Element("需要", "yes"), Element("无需", "no")],
-                    **ps(limit=2, limit_items=2),
-                ): {DDMenu("接收二次确认", "trade_revision", self.on_trade_revision)},
-                Menu("交易详情公共", "__trade_public", self.on_trade_details_public, **ms(back_to="trade_list")): {
-                    DMenu("💲 进行交易", "exchange_public", "💲 请选择您的交易方式:"): {
-                        DMenu("💲 以物易物", "exchange_public_item", self.on_exchange),
-                        DMenu("💲 使用硬币", "exchange_public_coin", self.on_exchange_coin),
-                    },
-                    DMenu("⚠️ 举报交易", "report_public", self.on_report): None,
-                    DMenu("💬 在线咨询", "contact_public", self.on_contact): None,
-                },
-                Menu("交易详情管理", "__trade_admin", self.on_trade_details_public, **ms(back_to="trade_list")): {
-                    DMenu("💲 进行交易", "exchange_admin", "💲 请选择您的交易方式:"): {
-                        DMenu("💲 以物易物", "exchange_admin_item", self.on_exchange),
-                        DMenu("💲 使用硬币", "exchange_admin_coin", self.on_exchange_coin),
-                    },
-                    DMenu("💬 在线咨询", "contact_admin", self.on_contact): None,
-                    DMenu("✅ 审核通过", "checked_admin", self.on_checked): None,
-                    ContentPageMenu(
-                        "⚠️ 举报管理",
-                        "report_admin",
-                        self.content_report_admin,
-                        header="👇🏼 请选择举报信息以查看:",
-                        **ps(limit=4, limit_items=4),
-                    ): {
-                        DMenu("举报详情", "report_details", self.on_report_details): {
-                            DMenu("✅ 同意", "report_accept", self.on_report_accept),
-                            DMenu("⚠️ 拒绝", "report_decline", self.on_report_decline),
-                        }
-                    },
-                    DMenu("🚫 立刻删除", "violation", self.on_violation): None,
-                },
-                Menu("交易详情我的", "__trade_mine", self.on_trade_details_mine, **ms(back_to="trade_list")): {
-                    DMenu("▶️ 上架下架", "launch", self.on_launch): None,
-                    DMenu("🚮 删除交易", "delete", self.on_delete): None,
-                    DMenu("🔄 编辑交易", "modify", self.on_modify): None,
-                    DMenu("🔗 分享交易", "share", self.on_share): None,
-                    ContentPageMenu(
-                        "📩 交换请求",
-                        "trade_exchange_list",
-                        self.content_trade_exchange_list,
-                        header="👇 请按序号选择您需要查询的交换请求:\n",
-                        **ps(limit=3, limit_items=6),
-                    ): {DMenu("接收交换请求", "trade_exchange", self.on_trade_exchange)},
-                },
-                ContentPageMenu(
-                    "➕ 增加用户组",
-                    "__user_level_add",
-                    self.content_user_level_add,
-                    header="👇🏼 请选择用户组以添加:",
-                    **ps(limit=5, limit_items=10, back_to="user"),
-                ): {DMenu("添加用户组", "user_level_add", self.on_user_level_add)},
-                PageMenu(
-                    "✅ 确认",
-                    "__user_restriction",
-                    self.on_user_restriction_ok,
-                    [Element(str(h), str(h)) for h in [1, 3, 7, 30, 360]],
-                    **ps(limit=5, limit_items=5, back_to="user"),
-                ): {DMenu("接收时长", "user_restriction_time", self.on_user_restriction)},
-                ContentPageMenu(
-                    "➕ 增加权限",
-                    "__level_field_add",
-                    self.content_level_field_add,
-                    header="👇🏼 请选择权限以添加, 或输入以手动添加:",
-                    **ps(limit=5, limit_items=10),
-                ): {DMenu("添加权限", "level_field_add", self.on_level_field_add)},
-            }
-        )
+        return transform(_bind_menu(_MENU_SKELETON, self))
 
     @useroper(None, conversation=True)
     async def text_handler(self, client: Client, message: TM, user: User):
@@ -504,256 +1020,324 @@ class Bot(metaclass=Singleton):
                     reply_to_user=minfo.from_user.uid,
                 )
                 m = await message.reply("✅ 已发送.")
-                await asyncio.sleep(0.5)
-                await m.delete()
+                self.delete_later(m)
                 return
             else:
-                await message.reply("⚠️ 不受支持的信息类型.")
-                await asyncio.sleep(0.5)
-                await m.delete()
+                m = await message.reply("⚠️ 不受支持的信息类型.")
+                self.delete_later(m)
                 return
-        conv = self._user_conversion.get((message.chat.id, user.uid), None)
+        conv = self._user_conversion.get(str(user.uid), None)
         if not conv:
             message.continue_propagation()
-        if conv.status == ConversationStatus.WAITING_REPORT:
-            if message.text:
-                if message.text.startswith("/"):
-                    message.continue_propagation()
-            t = Trade.get_by_id(int(conv.params["trade_id"]))
-            e = Exchange.get_by_id(int(conv.params["exchange_id"]))
-            to_trade = conv.params["to_trade"]
-            problem = conv.params["report_after_trade_problem_id"]
-            if to_trade:
-                if problem == "no_good":
-                    type = DisputeType.EXCHANGE_NO_GOOD
-                elif problem == "not_as_description":
-                    type = DisputeType.EXCHANGE_NOT_AS_DESCRIPTION
-            else:
-                if problem == "no_good":
-                    type = DisputeType.TRADE_NO_GOOD
-                elif problem == "not_as_description":
-                    type = DisputeType.TRADE_NOT_AS_DESCRIPTION
+        if message.text:
+            handler = self._conv_text_handlers.get(conv.status, None)
+            if not handler:
+                message.continue_propagation()
+        elif message.photo:
+            handler = self._conv_photo_handlers.get(conv.status, None)
+            if not handler:
+                return
+        else:
+            return
+        return await handler(client, message, conv, user)
+
+    async def _handle_waiting_report(self, client: Client, message: TM, conv: Conversation, user: User):
+        t, e = await asyncio.gather(
+            db_thread(get_trade_with_user, int(conv.params["trade_id"])),
+            db_thread(get_exchange_with_user, int(conv.params["exchange_id"])),
+        )
+        to_trade = conv.params["to_trade"]
+        problem = conv.params["report_after_trade_problem_id"]
+        if to_trade:
+            if problem == "no_good":
+                type = DisputeType.EXCHANGE_NO_GOOD
+            elif problem == "not_as_description":
+                type = DisputeType.EXCHANGE_NOT_AS_DESCRIPTION
+        else:
+            if problem == "no_good":
+                type = DisputeType.TRADE_NO_GOOD
+            elif problem == "not_as_description":
+                type = DisputeType.TRADE_NOT_AS_DESCRIPTION
+        penalty = sqrt(max(t.coins, 10))
+
+        def raise_dispute():
             with db.atomic():
-                d = Dispute.create(
+                did = Dispute.insert(
                     trade=t,
                     user=user,
                     type=type,
                     description=message.caption or message.text,
                     photo=message.photo.file_id if message.photo else None,
-                    influence=sqrt(max(t.coins, 10)),
-                )
+                    influence=penalty,
+                ).execute()
                 target = e.user if to_trade else t.user
-                target.sanity = max(target.sanity - sqrt(max(t.coins, 10)), 0)
-                target.save()
-                log = Log.create(initiator=user, activity="raise dispute after trade", details=str(d.id))
-                log.participants.add(target)
-                logger.debug(f"{user.name} 认为与 {(e.user if to_trade else t.user).name} 的交易存在 {type.name} 问题.")
-                await message.reply("✅ 成功提交举报, 将等待管理员确认后, 给予对方一定惩罚.")
-                return
-        if message.text:
-            if message.text.startswith("/"):
-                message.continue_propagation()
-            elif conv.status == ConversationStatus.WAITING_EXCHANGE:
-                t = Trade.get_by_id(int(conv.params["trade_id"]))
-                if t.revision:
-                    target = "__exchange_add_desc"
-                else:
-                    target = "__exchange_submitted"
-                await self.to_menu(client, message, target, exchange=message.text, **conv.params)
-            elif conv.status == ConversationStatus.WAITING_EXCHANGE_DESC:
-                if len(message.text) > 100:
-                    self.set_conversation(user, conv.context, ConversationStatus.WAITING_EXCHANGE_DESC)
-                    await message.reply("⚠️ 过长, 最大长度为100.")
-                else:
-                    await self.to_menu(
-                        client, message, "__exchange_submitted", exchange_desc=message.text, **conv.params
-                    )
-            elif conv.status == ConversationStatus.WAITING_TRADE_NAME:
-                if len(message.text) > 20:
-                    self.set_conversation(user, conv.context, ConversationStatus.WAITING_TRADE_NAME)
-                    await message.reply("⚠️ 过长, 最大长度为20.")
-                else:
-                    await self.to_menu(
-                        client, message, "__trade_add_desc", trade_name=message.text, **conv.params
-                    )
-            elif conv.status == ConversationStatus.WAITING_TRADE_DESC:
-                if len(message.text) > 100:
-                    self.set_conversation(user, conv.context, ConversationStatus.WAITING_TRADE_DESC)
-                    await message.reply("⚠️ 过长, 最大长度为100.")
-                else:
-                    await self.to_menu(
-                        client, message, "__trade_add_photo", trade_desc=message.text, **conv.params
-                    )
-            elif conv.status == ConversationStatus.WAITING_TRADE_GOOD:
-                self.set_conversation(
-                    user, conv.context, ConversationStatus.WAITING_EXCHANGE_FOR, trade_good=message.text
-                )
-                msg = "👉🏼 请输入你**需要**的物品名称 (尽可能简短):"
-                if conv.params.get("trade_modify", False):
-                    t = Trade.get_by_id(int(conv.params["trade_id"]))
-                    msg += f"\n🔄 (当前: `{t.exchange}`)"
-                await message.reply(msg)
-
-            elif conv.status == ConversationStatus.WAITING_EXCHANGE_FOR:
-                if len(message.text) > 100:
-                    self.set_conversation(user, conv.context, ConversationStatus.WAITING_EXCHANGE_FOR)
-                    return await message.reply("⚠️ 过长, 最大长度为100.")
-                self.set_conversation(
-                    user, conv.context, ConversationStatus.WAITING_COINS, trade_exchange_for=message.text
-                )
-                msg = dedent(
-                    """
-                👉🏼 请输入您的物品的等值价值
-                
-                用户可以用硬币购买您的物品, 并扣除 10% 手续费.
-                输入 0 以禁用硬币购买.
-                
-                价值参考:
-                
-                1     - 群组推荐
-                10    - 网易云会员七天兑换码
-                100   - Emby 邀请码
-                1000  - Telegram 账号
-                10000 - 奥德赛 Emby 邀请码
-                {conv}
-                **请注意**: 请勿设置过高, 若对方认定您的商品虚假, 将导致大量扣信用分.
-                """
-                ).strip()
-                if conv.params.get("trade_modify", False):
-                    t = Trade.get_by_id(int(conv.params["trade_id"]))
-                    msg = msg.format(conv=f"\n🔄 (当前: `{t.coins}`)\n")
-                else:
-                    msg = msg.format(conv="")
-                await message.reply(msg)
-            elif conv.status == ConversationStatus.WAITING_COINS:
-                retry = False
-                try:
-                    coins = int(message.text)
-                except ValueError:
-                    retry = True
-                else:
-                    if coins < 0:
-                        retry = True
-                history_sold = (
-                    Trade.select()
-                    .where(Trade.status == TradeStatus.SOLD)
-                    .join(User)
-                    .where(User.id == user.id)
-                    .count()
-                )
-                if (history_sold + 1) * 1000 * pow(user.sanity / 100, 10) < coins:
-                    retry = "⚠️ 金额过大, 请进行更多交易或提升信用."
-                if retry:
-                    self.set_conversation(user, conv.context, ConversationStatus.WAITING_COINS)
-                    await message.reply(retry if isinstance(retry, str) else "⚠️ 输入错误, 请重新输入.")
-                else:
-                    await self.to_menu(
-                        client, message, "__trade_set_start_time", trade_coins=coins, **conv.params
-                    )
-            elif conv.status == ConversationStatus.WAITING_TRADE_START_TIME:
-                try:
-                    trade_start_time = parser.parse(message.text)
-                except parser.ParserError:
-                    await message.reply("⚠️ 输入错误, 请重新输入.")
-                    await self.to_menu(client, message, "__trade_set_start_time", **conv.params)
-                else:
-                    await self.to_menu(
-                        client, message, "__trade_set_revision", trade_start_time=trade_start_time.timestamp(), **conv.params
-                    )
-            elif conv.status == ConversationStatus.WAITING_USER:
-                user_id = message.text
-                try:
-                    u = await client.get_users(user_id)
-                    if User.get_or_none(uid=u.id):
-                        return await self.to_menu(client, message, "user", user_id=u.id)
-                except BadRequest:
-                    pass
-                uns = {u.uid: u.name for u in User.select().iterator()}
-                results = process.extract(user_id, uns, limit=5)
-                uids = [uid for _, score, uid in results if score > 75]
-                if len(uids) > 1:
-                    return await self.to_menu(client, message, "list_users", user_ids=uids)
-                elif len(uids) == 1:
-                    return await self.to_menu(client, message, "user", user_id=uids[0])
-                else:
-                    await message.reply("⚠️ 未找到该用户.")
-            elif conv.status == ConversationStatus.WAITING_MESSAGE:
-                uid = conv.context.parameters.get("user_id", None)
-                uids = conv.context.parameters.get("user_ids", [])
-                cond = conv.context.parameters.get("cond", None)
-                if uid:
-                    urs = User.select().where(User.uid == uid)
-                elif uids:
-                    urs = User.select().where(User.uid.in_(uids))
-                elif cond:
-                    urs = User.select().where(cond)
-                else:
-                    urs = User.select()
-                fails = 0
-                count = urs.count()
-                m = await message.reply(f"🔄 正在发送.")
-                for i, ur in enumerate(urs.iterator()):
+                adjust_user(target, sanity=-penalty)
+                return did, target
+
+        did, target = await db_thread(raise_dispute)
+        self.add_log(user, "raise dispute after trade", str(did), [target])
+        logger.debug(f"{user.name} 认为与 {target.name} 的交易存在 {type.name} 问题.")
+        await message.reply("✅ 成功提交举报, 将等待管理员确认后, 给予对方一定惩罚.")
+
+    async def _handle_waiting_exchange(self, client: Client, message: TM, conv: Conversation, user: User):
+        t = await db_thread(Trade.get_by_id, int(conv.params["trade_id"]))
+        if t.revision:
+            target = "__exchange_add_desc"
+        else:
+            target = "__exchange_submitted"
+        await self.to_menu(client, message, target, exchange=message.text, **conv.params)
+
+    async def _handle_waiting_exchange_desc(
+        self, client: Client, message: TM, conv: Conversation, user: User
+    ):
+        if len(message.text) > 100:
+            self.set_conversation(user, conv.context, ConversationStatus.WAITING_EXCHANGE_DESC)
+            await message.reply("⚠️ 过长, 最大长度为100.")
+        else:
+            await self.to_menu(
+                client, message, "__exchange_submitted", exchange_desc=message.text, **conv.params
+            )
+
+    async def _handle_waiting_trade_name(self, client: Client, message: TM, conv: Conversation, user: User):
+        if len(message.text) > 20:
+            self.set_conversation(user, conv.context, ConversationStatus.WAITING_TRADE_NAME)
+            await message.reply("⚠️ 过长, 最大长度为20.")
+        else:
+            await self.to_menu(client, message, "__trade_add_desc", trade_name=message.text, **conv.params)
+
+    async def _handle_waiting_trade_desc(self, client: Client, message: TM, conv: Conversation, user: User):
+        if len(message.text) > 100:
+            self.set_conversation(user, conv.context, ConversationStatus.WAITING_TRADE_DESC)
+            await message.reply("⚠️ 过长, 最大长度为100.")
+        else:
+            await self.to_menu(client, message, "__trade_add_photo", trade_desc=message.text, **conv.params)
+
+    async def _handle_waiting_trade_good(self, client: Client, message: TM, conv: Conversation, user: User):
+        self.set_conversation(
+            user, conv.context, ConversationStatus.WAITING_EXCHANGE_FOR, trade_good=message.text
+        )
+        msg = "👉🏼 请输入你**需要**的物品名称 (尽可能简短):"
+        if conv.params.get("trade_modify", False):
+            t = await db_thread(Trade.get_by_id, int(conv.params["trade_id"]))
+            msg += f"\n🔄 (当前: `{t.exchange}`)"
+        await message.reply(msg)
+
+    async def _handle_waiting_exchange_for(self, client: Client, message: TM, conv: Conversation, user: User):
+        if len(message.text) > 100:
+            self.set_conversation(user, conv.context, ConversationStatus.WAITING_EXCHANGE_FOR)
+            return await message.reply("⚠️ 过长, 最大长度为100.")
+        self.set_conversation(
+            user, conv.context, ConversationStatus.WAITING_COINS, trade_exchange_for=message.text
+        )
+        if conv.params.get("trade_modify", False):
+            t = await db_thread(Trade.get_by_id, int(conv.params["trade_id"]))
+            msg = _COINS_PROMPT.format(conv=f"\n🔄 (当前: `{t.coins}`)\n")
+        else:
+            msg = _COINS_PROMPT.format(conv="")
+        await message.reply(msg)
+
+    async def _handle_waiting_coins(self, client: Client, message: TM, conv: Conversation, user: User):
+        retry = False
+        try:
+            coins = int(message.text)
+        except ValueError:
+            retry = True
+        else:
+            if coins < 0:
+                retry = True
+        history_sold = await db_thread(
+            Trade.select().where(Trade.status == TradeStatus.SOLD).join(User).where(User.id == user.id).count
+        )
+        if (history_sold + 1) * 1000 * (user.sanity / 100) ** 10 < coins:
+            retry = "⚠️ 金额过大, 请进行更多交易或提升信用."
+        if retry:
+            self.set_conversation(user, conv.context, ConversationStatus.WAITING_COINS)
+            await message.reply(retry if isinstance(retry, str) else "⚠️ 输入错误, 请重新输入.")
+        else:
+            await self.to_menu(client, message, "__trade_set_start_time", trade_coins=coins, **conv.params)
+
+    async def _handle_waiting_trade_start_time(
+        self, client: Client, message: TM, conv: Conversation, user: User
+    ):
+        try:
+            try:
+                trade_start_time = datetime.strptime(message.text.strip(), "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                trade_start_time = await to_thread(_parse_date, message.text)
+        except parser.ParserError:
+            await message.reply("⚠️ 输入错误, 请重新输入.")
+            await self.to_menu(client, message, "__trade_set_start_time", **conv.params)
+        else:
+            await self.to_menu(
+                client,
+                message,
+                "__trade_set_revision",
+                trade_start_time=trade_start_time.timestamp(),
+                **conv.params,
+            )
+
+    async def _handle_waiting_user(self, client: Client, message: TM, conv: Conversation, user: User):
+        user_id = message.text
+        if user_id != "0" and user_id in self._name_index:
+            return await self.to_menu(client, message, "user", user_id=int(user_id))
+        try:
+            u = await client.get_users(user_id)
+            if await db_thread(User.select().where(User.uid == u.id).exists):
+                return await self.to_menu(client, message, "user", user_id=u.id)
+        except BadRequest:
+            pass
+        results = process.extract(
+            user_id,
+            self._name_index,
+            scorer=fuzz.WRatio,
+            processor=fuzz_utils.default_process,
+            score_cutoff=75,
+            limit=5,
+        )
+        uids = [uid for _, _, uid in results]
+        if len(uids) > 1:
+            return await self.to_menu(client, message, "list_users", user_ids=uids)
+        elif len(uids) == 1:
+            return await self.to_menu(client, message, "user", user_id=uids[0])
+        else:
+            await message.reply("⚠️ 未找到该用户.")
+
+    async def _handle_waiting_message(self, client: Client, message: TM, conv: Conversation, user: User):
+        uid = conv.context.parameters.get("user_id", None)
+        uids = conv.context.parameters.get("user_ids", [])
+        cond = conv.context.parameters.get("cond", None)
+        if uid:
+            urs = User.select(User.uid).where(User.uid == uid)
+        elif uids:
+            urs = User.select(User.uid).where(User.uid.in_(uids))
+        elif cond:
+            urs = User.select(User.uid).where(cond)
+        else:
+            urs = User.select(User.uid)
+        text = f"📢 管理员提醒:\n\n{message.text}"
+        # Parse the markdown once and send the resulting entities to every recipient;
+        # user mentions need peer resolution per message, so they keep the markdown path.
+        parsed = await client.parser.parse(text, ParseMode.MARKDOWN)
+        raw_entities = parsed["entities"] or []
+        if any(isinstance(e, raw.types.InputMessageEntityMentionName) for e in raw_entities):
+            send_kw = {"parse_mode": ParseMode.MARKDOWN}
+        else:
+            text = parsed["message"]
+            entities = [MessageEntity._parse(client, e, {}) for e in raw_entities]
+            send_kw = {"parse_mode": ParseMode.DISABLED, "entities": entities}
+
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send_one(uid):
+            async with sem:
+                while True:
                     try:
-                        await client.send_message(
-                            ur.uid, f"📢 管理员提醒:\n\n{message.text}", parse_mode=ParseMode.MARKDOWN
-                        )
-                    except BadRequest:
-                        fails += 1
-                    await m.edit_text(f"🔄 正在发送: {i+1}/{count} 个用户.")
-                if i == 0:
-                    await m.edit_text(f"✅ 已发送.")
-                else:
-                    await m.edit_text(f"✅ 已发送给 {i+1} 个用户, 其中 {fails} 个发送错误.")
-            elif conv.status == ConversationStatus.WAITING_FIELD:
-                fr = Field.get_or_create(name=message.text)
-                await self.to_menu(
-                    client,
-                    message,
-                    "level_field_add",
-                    level_id=conv.params["level"].id,
-                    level_field_add_id=fr.id,
-                )
-            elif conv.status == ConversationStatus.WAITING_SEARCH_TRADE:
-                tns = {t.id: f'{t.name} {t.exchange}' for t in Trade.select().iterator()}
-                results = process.extract(message.text, tns, limit=30, scorer=fuzz.partial_ratio)
-                tids = [tid for _, score, tid in results if score > 50]
-                if len(tids) > 1:
-                    return await self.to_menu(client, message, "trade_list", trade_ids=tids)
-                elif len(tids) == 1:
-                    return await self.to_menu(client, message, "trade_details", trade_details_id=tids[0])
-                else:
-                    await message.reply("⚠️ 未找到该交易.")
-            elif conv.status == ConversationStatus.CHATING:
-                t = Trade.get_by_id(int(conv.params["trade_id"]))
-                u = conv.params.get("reply_to_user", t.user.uid)
-                m = await client.send_message(
-                    u,
-                    f"💬 __{user_spec(user)}__ 向您发送了 **{t.name}** 相关会话:\n\n{message.text}\n\n(回复该信息以开始与对方聊天)",
-                )
-                self._user_messages[m.id] = MessageInfo(from_user=user, trade=t)
-                m = await message.reply("✅ 已发送")
-                await asyncio.sleep(0.5)
-                await m.delete()
-            else:
-                message.continue_propagation()
-        elif message.photo:
-            if conv.status == ConversationStatus.WAITING_TRADE_PHOTO:
-                self.set_conversation(
-                    user,
-                    conv.context,
-                    ConversationStatus.WAITING_TRADE_GOOD,
-                    trade_photo=message.photo.file_id,
-                )
-                msg = "👉🏼 请输入你的物品**内容** (例如密钥等, 暂不支持图片):"
-                if conv.params.get("trade_modify", False):
-                    t = Trade.get_by_id(int(conv.params["trade_id"]))
-                    msg += f"\n🔄 当前密文内容请点击查看:\n\n||{t.good}||"
-                await message.reply(msg)
+                        await client.send_message(uid, text, **send_kw)
+                    except FloodWait as e:
+                        await asyncio.sleep(e.value)
+                    except RPCError:
+                        return 1
+                    else:
+                        return 0
+
+        fails = 0
+        sent = 0
+        # Read all targets up front so that no cursor stays open while messages are sent.
+        uid_list = await db_thread(lambda: [uid for uid, in urs.tuples().iterator()])
+        count = len(uid_list)
+        last_edit = time.monotonic()
+        m = await message.reply(f"🔄 正在发送.")
+        sends = [asyncio.ensure_future(send_one(uid)) for uid in uid_list]
+        try:
+            for fut in asyncio.as_completed(sends):
+                fails += await fut
+                sent += 1
+                now = time.monotonic()
+                if sent < count and now - last_edit > BROADCAST_EDIT_INTERVAL:
+                    last_edit = now
+                    await m.edit_text(f"🔄 正在发送: {sent}/{count} 个用户.")
+        except Exception as e:
+            logger.opt(exception=e).warning("群发消息时出现错误.")
+        finally:
+            for fut in sends:
+                fut.cancel()
+        if sent < count:
+            await m.edit_text(f"⚠️ 发送中断: 已发送给 {sent}/{count} 个用户, 其中 {fails} 个发送错误.")
+        elif sent <= 1:
+            await m.edit_text(f"✅ 已发送.")
+        else:
+            await m.edit_text(f"✅ 已发送给 {sent} 个用户, 其中 {fails} 个发送错误.")
+
+    async def _handle_waiting_field(self, client: Client, message: TM, conv: Conversation, user: User):
+        fr, created = Field.get_or_create(name=message.text)
+        if created:
+            invalidate_fields()
+        await self.to_menu(
+            client,
+            message,
+            "level_field_add",
+            level_id=conv.params["level"].id,
+            level_field_add_id=fr.id,
+        )
+
+    async def _handle_waiting_search_trade(self, client: Client, message: TM, conv: Conversation, user: User):
+        rows = await db_thread(
+            lambda: list(Trade.select(Trade.id, Trade.name, Trade.exchange).tuples().iterator())
+        )
+        choices = {}
+        for tid, name, exchange in rows:
+            choices[(tid, "n")] = name
+            if exchange:
+                choices[(tid, "e")] = exchange
+        results = process.extract(
+            message.text,
+            choices,
+            limit=30,
+            scorer=fuzz.partial_ratio,
+            processor=fuzz_utils.default_process,
+            score_cutoff=50,
+        )
+        tids = list(dict.fromkeys(tid for _, _, (tid, _) in results))
+        if len(tids) > 1:
+            return await self.to_menu(client, message, "trade_list", trade_ids=tids)
+        elif len(tids) == 1:
+            return await self.to_menu(client, message, "trade_details", trade_details_id=tids[0])
+        else:
+            await message.reply("⚠️ 未找到该交易.")
+
+    async def _handle_chating(self, client: Client, message: TM, conv: Conversation, user: User):
+        t = await db_thread(get_trade_with_user, int(conv.params["trade_id"]))
+        u = conv.params.get("reply_to_user", t.user.uid)
+        m = await client.send_message(
+            u,
+            f"💬 __{user_spec(user)}__ 向您发送了 **{t.name}** 相关会话:\n\n{message.text}\n\n(回复该信息以开始与对方聊天)",
+        )
+        self._user_messages[m.id] = MessageInfo(from_user=user, trade=t)
+        m = await message.reply("✅ 已发送")
+        self.delete_later(m)
+
+    async def _handle_waiting_trade_photo(self, client: Client, message: TM, conv: Conversation, user: User):
+        self.set_conversation(
+            user,
+            conv.context,
+            ConversationStatus.WAITING_TRADE_GOOD,
+            trade_photo=message.photo.file_id,
+        )
+        msg = "👉🏼 请输入你的物品**内容** (例如密钥等, 暂不支持图片):"
+        if conv.params.get("trade_modify", False):
+            t = await db_thread(Trade.get_by_id, int(conv.params["trade_id"]))
+            msg += f"\n🔄 当前密文内容请点击查看:\n\n||{t.good}||"
+        await message.reply(msg)
 
     async def inline_handler(self, client: Client, inline_query: TI):
         try:
             query = int(inline_query.query)
-            t = Trade.get_or_none(id=query)
+            t = (
+                Trade.select(Trade.id, Trade.name, Trade.exchange, User.uid, User.name, User.anonymous)
+                .join(User)
+                .where(Trade.id == query)
+                .get_or_none()
+            )
             if not t:
                 raise ValueError
             if not int(t.user.uid) == inline_query.from_user.id:
@@ -810,11 +1394,6 @@ class Bot(metaclass=Singleton):
                 elif cmds[1].startswith("__u_"):
                     return await self.to_menu(client, context, "user", user_id=remove_prefix(cmds[1], "__u_"))
         name = context.from_user.name
-        if user.name != name:
-            with db.atomic():
-                user.name = name
-                user.save()
-                Log.create(initiator=user, activity="updated username")
         msg = f"🌈 您好 {name}, 欢迎使用 **易物 Exchanger**!"
         return InputMediaPhoto(media=self._logo, caption=msg, parse_mode=ParseMode.MARKDOWN)
 
@@ -826,74 +1405,74 @@ class Bot(metaclass=Singleton):
         if isinstance(context, TC):
             await context.edit_message_media((InputMediaPhoto(self._logo)))
         is_admin = user_has_field(user, "admin_trade")
+        can_add = user_has_field(user, "add_trade")
         mine = parameters.get("mine", False)
+        if not (mine or is_admin or can_add):
+            return []
         if mine:
             ts = (
-                Trade.select()
+                Trade.select(*_TRADE_LIST_FIELDS)
                 .where(Trade.deleted == False)
                 .join(User)
                 .where(User.id == user.id)
                 .order_by(Trade.status, Trade.modified.desc())
-            ).iterator()
+                .namedtuples()
+                .iterator()
+            )
         elif is_admin:
 
             def gen():
-                tids = []
+                tids = set()
                 for t in (
-                    Trade.select()
+                    Trade.select(*_TRADE_LIST_FIELDS)
                     .where(Trade.status < TradeStatus.DISPUTED, Trade.deleted == False)
                     .join(Dispute)
                     .order_by(Dispute.type.desc())
                     .group_by(Trade)
                     .order_by(Trade.modified.desc())
+                    .namedtuples()
                     .iterator()
                 ):
-                    tids.append(t.id)
+                    tids.add(t.id)
                     yield t
                 for t in (
-                    Trade.select()
+                    Trade.select(*_TRADE_LIST_FIELDS)
                     .where(Trade.deleted == False)
                     .where((Trade.status == TradeStatus.LAUNCHED) | (Trade.status == TradeStatus.CHECKING))
                     .order_by(Trade.status, Trade.modified.desc())
+                    .namedtuples()
                     .iterator()
                 ):
-                    if not t.id in tids:
+                    if t.id not in tids:
                         yield t
 
             ts = gen()
         else:
             ts = (
-                Trade.select()
+                Trade.select(*_TRADE_LIST_FIELDS)
                 .where(Trade.status == TradeStatus.LAUNCHED, Trade.deleted == False)
                 .join(User)
                 .where(User.sanity >= 70)
-                .group_by(Trade)
+                .namedtuples()
                 .iterator()
             )
         items = []
-        icons = {
-            TradeStatus.PENDING: "📝",
-            TradeStatus.CHECKING: "🛡️",
-            TradeStatus.LAUNCHED: "🛒",
-            TradeStatus.SOLD: "🤝",
-            TradeStatus.TIMEDOUT: "⌛️",
-            TradeStatus.DISPUTED: "🤔",
-            TradeStatus.VIOLATION: "🚫",
-        }
         need_admin = True
-        only_list = parameters.get('trade_ids', None)
+        if is_admin:
+            dispute_counts = dict(
+                Dispute.select(Dispute.trade, fn.COUNT(Dispute.id)).group_by(Dispute.trade).tuples()
+            )
+        only_list = set(parameters.get("trade_ids") or ())
         for i, t in enumerate(ts):
             if only_list and t.id not in only_list:
                 continue
             if mine or is_admin:
-                spec = f"{icons[t.status]} `{i+1}`"
+                spec = f"{_STATUS_ICONS[t.status]} `{i+1}`"
             else:
-                if not user_has_field(user, "add_trade"):
-                    continue
                 spec = f"`{i+1: >3}`"
             annotation = ""
             if is_admin and need_admin:
-                disputes = Dispute.select().join(Trade).where(Trade.id == t.id).count()
+                disputes = dispute_counts.get(t.id, 0)
                 checking = t.status == TradeStatus.CHECKING and not t.deleted
                 if not disputes and not checking:
                     need_admin = False
@@ -902,9 +1481,7 @@ class Bot(metaclass=Singleton):
                 elif checking:
                     annotation = " (--需要检查--)"
             spec += (
-                f" | __{truncate_str(t.exchange, 12)}__{annotation}\n"
-                + " " * 5
-                + f"=> **{truncate_str(t.name, 10)}**\n"
+                f" | __{truncate_str(t.exchange, 12)}__{annotation}\n     => **{truncate_str(t.name, 10)}**\n"
             )
             items.append((spec, str(i + 1), str(t.id)))
         return items
@@ -913,32 +1490,34 @@ class Bot(metaclass=Singleton):
     async def on_trade_details_public(
         self, handler, client: Client, context: Union[TM, TC], parameters: dict, user: User
     ):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        owner_trade = Trade.alias()
+        sold = owner_trade.select(fn.COUNT(owner_trade.id)).where(
+            owner_trade.user == Trade.user, owner_trade.status == TradeStatus.SOLD
+        )
+        t = (
+            Trade.select(Trade, User, fn.COUNT(Dispute.id).alias("dispute_count"), sold.alias("owner_sold"))
+            .join(User)
+            .switch(Trade)
+            .join(Dispute, JOIN.LEFT_OUTER)
+            .where(Trade.id == int(parameters["trade_id"]))
+            .group_by(Trade, User)
+            .get()
+        )
+        owner = t.user
         is_admin = user_has_field(user, "admin_trade")
 
-        if t.status == TradeStatus.CHECKING:
-            msg = "🛍️ **需要检查**"
-        elif t.status == TradeStatus.LAUNCHED:
-            if t.available and t.available > datetime.now():
-                msg = f"🛍️ 交易将在 {t.available.strftime('%Y-%m-%d %H:%M:%S')} 可用."
-            else:
-                msg = f"🛍️ 交易详情"
-        elif t.status == TradeStatus.SOLD:
-            msg = "🛍️ 交易成功"
-        elif t.status == TradeStatus.TIMEDOUT:
-            msg = "🛍️ 因**过久未更新**被下架"
-        elif t.status == TradeStatus.DISPUTED:
-            msg = "🛍️ 正处于**纠纷锁定**状态"
-        elif t.status == TradeStatus.VIOLATION:
-            msg = "🛍️ 因**违反用户协议**被移除"
+        if t.status == TradeStatus.LAUNCHED and t.available and t.available > datetime.now():
+            msg = f"🛍️ 交易将在 {t.available.strftime('%Y-%m-%d %H:%M:%S')} 可用."
+        else:
+            msg = _PUBLIC_STATUS_MSG.get(t.status, "🛍️ 交易详情")
 
         if t.deleted:
             msg += " (已删除)"
 
         if is_admin:
-            msg += f"\n\n[{t.user.name}](tg://user?id={user.uid}) ([管理](t.me/{client.me.username}?start=__u_{user.uid})) 正在出售:\n"
+            msg += f"\n\n[{owner.name}](tg://user?id={user.uid}) ([管理](t.me/{client.me.username}?start=__u_{user.uid})) 正在出售:\n"
         else:
-            msg += f"\n\n__{user_spec(t.user)}__ 正在出售:\n"
+            msg += f"\n\n__{user_spec(owner)}__ 正在出售:\n"
         msg += f"**{t.name}**"
         if t.description:
             msg += f"\n{t.description}"
@@ -948,24 +1527,23 @@ class Bot(metaclass=Singleton):
         else:
             msg += "\n\n"
         msg += f"交易发起日期: {t.created.strftime('%Y-%m-%d')}\n"
-        disputes = Dispute.select().join(Trade).where(Trade.id == t.id).count()
+        disputes = t.dispute_count
         if disputes:
             msg += f"当前该交易有 {disputes} 个举报, "
-        msg += f"对方的信用分为 {t.user.sanity}"
-        if t.user.sanity < 75:
+        msg += f"对方的信用分为 {owner.sanity}"
+        if owner.sanity < 75:
             msg += " **(极低)**, "
-        if t.user.sanity < 90:
+        if owner.sanity < 90:
             msg += " **(较低)**, "
         else:
             msg += ", "
-        msg += f"售出过 {t.user.trades.where(Trade.status == TradeStatus.SOLD).count()} 件商品.\n"
+        msg += f"售出过 {t.owner_sold} 件商品.\n"
         if t.revision:
             msg += f"**非即时**:\n您提供该物品后, 交易将需要对方检查其描述才能完成. 若对方拒绝交易, 您的物品密文将不会展现."
         else:
             msg += f"**即时**: 您提供对方所需物品后, 交易将立即完成."
 
         if is_admin:
-            disputes = Dispute.select().join(Trade).where(Trade.id == t.id).count()
             if disputes:
                 msg += f"\n\n**👑 管理员事务: 该交易有 {disputes} 个争议**\n"
             if t.status == TradeStatus.CHECKING and not t.deleted:
@@ -981,13 +1559,46 @@ class Bot(metaclass=Singleton):
 
     async def header_trade_list(self, handler, client: Client, context: TM, parameters):
         menu = handler["trade_list"]
-        items = len(flatten2(menu.entries))
+        items = sum(map(len, menu.entries))
         mine = parameters.get("mine", False)
         if mine:
             return f"🛍️ 我的交易 - 共 {items} 交易\n"
         else:
             return f"🛍️ 交易大厅 - 共 {items} 交易\n"
 
+    def get_trade(self, tid: int):
+        now = time.monotonic()
+        cached = self._trade_cache.get(tid)
+        if cached and now - cached[0] < TRADE_CACHE_TTL:
+            return cached[1]
+        t = get_trade_with_user(tid)
+        self._trade_cache[tid] = (now, t)
+        return t
+
+    def get_exchange(self, eid: int):
+        now = time.monotonic()
+        cached = self._exchange_cache.get(eid)
+        if cached and now - cached[0] < TRADE_CACHE_TTL:
+            return cached[1]
+        e = get_exchange_with_user(eid)
+        self._exchange_cache[eid] = (now, e)
+        return e
+
+    def evict_trade(self, t: Trade, e: Exchange = None):
+        # Cached rows are shared between handlers, so writers load their own rows and drop the cached copies.
+        self._trade_cache.pop(t.id, None)
+        if e:
+            self._exchange_cache.pop(e.id, None)
+
+    async def _open_exchange(self, context: TC, parameters: dict):
+        t = get_trade_with_user(int(parameters["trade_id"]))
+        e = get_exchange_with_user(int(parameters["exchange_id"])) if t.status == TradeStatus.LAUNCHED else None
+        if not e or e.status != ExchangeStatus.LAUNCHED:
+            await context.answer("⚠️ 该交易不再可用.")
+            await context.message.delete()
+            return t, None
+        return t, e
+
     def check_trade(self, t: Trade, user: User):
         if t.status != TradeStatus.LAUNCHED:
             return f"⚠️ 交易当前未上架."
@@ -996,12 +1607,12 @@ class Bot(metaclass=Singleton):
                 return f"⚠️ 交易仅在 {t.available.strftime('%Y-%m-%d %H:%M:%S')} 后可用!"
         if t.deleted:
             return f"⚠️ 交易已被删除."
-        if BlackList.select().where(BlackList.by == t.user, BlackList.of == user).get_or_none():
+        if BlackList.select().where(BlackList.by == t.user_id, BlackList.of == user).exists():
             return f"⚠️ 对方已将您拉黑, 无法交易."
 
     @useroper("exchange")
     async def on_exchange(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         check_msg = self.check_trade(t, user)
         if check_msg:
             return check_msg
@@ -1012,7 +1623,7 @@ class Bot(metaclass=Singleton):
 
     @useroper("exchange")
     async def on_exchange_coin(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         check_msg = self.check_trade(t, user)
         if check_msg:
             return check_msg
@@ -1025,17 +1636,14 @@ class Bot(metaclass=Singleton):
         if user.coins < t.coins:
             await context.answer("⚠️ 硬币不足.")
             return
-        with db.atomic():
-            user.coins -= t.coins
-            t.user.coins += t.coins
-            await self.to_menu(
-                client,
-                context,
-                "__exchange_submitted",
-                trade_id=t.id,
-                coins=t.coins,
-                exchange=f"{t.coins} 硬币",
-            )
+        await self.to_menu(
+            client,
+            context,
+            "__exchange_submitted",
+            trade_id=t.id,
+            coins=t.coins,
+            exchange=f"{t.coins} 硬币",
+        )
 
     @useroper()
     async def on_exchange_add_desc(self, handler, client: Client, context: TM, parameters: dict, user: User):
@@ -1053,7 +1661,7 @@ class Bot(metaclass=Singleton):
         self.set_conversation(user, context, ConversationStatus.WAITING_TRADE_DESC, params=params)
         msg = "📝 添加一个描述\n使交换者更加了解您的物品, 您可以直接输入您的描述, 或点击下方的**不添加**按钮以跳过.\n(**请勿输入任何密文**)"
         if parameters.get("trade_modify", False):
-            t = Trade.get_by_id(int(parameters["trade_id"]))
+            t = self.get_trade(int(parameters["trade_id"]))
             if t.description:
                 msg += f"\n🔄 (当前: `{t.description}`)"
             else:
@@ -1081,7 +1689,7 @@ class Bot(metaclass=Singleton):
         self.set_conversation(user, context, status=ConversationStatus.WAITING_TRADE_GOOD, params=params)
         msg = "👉🏼 请输入你的物品内容 (例如密钥等, 暂不支持图片):"
         if parameters.get("trade_modify", False):
-            t = Trade.get_by_id(int(parameters["trade_id"]))
+            t = self.get_trade(int(parameters["trade_id"]))
             msg += f"\n🔄 当前密文内容请点击查看:\n\n||{t.good}||"
         return msg
 
@@ -1095,7 +1703,7 @@ class Bot(metaclass=Singleton):
         )
         msg = "📝 指定时间才允许交易\n请输入 `YYYY-mm-dd hh:mm:ss` 格式的时间, 或点击下方的**不添加**按钮以跳过."
         if parameters.get("trade_modify", False):
-            t = Trade.get_by_id(int(parameters["trade_id"]))
+            t = self.get_trade(int(parameters["trade_id"]))
             if t.available > datetime.now():
                 msg += f'\n🔄 (当前: `{t.available.strftime("%Y-%m-%d %H:%M:%S")}`)'
             else:
@@ -1112,21 +1720,36 @@ class Bot(metaclass=Singleton):
     async def on_exchange_submitted(
         self, handler, client: Client, context: Union[TC, TM], parameters: dict, user: User
     ):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
         check_msg = self.check_trade(t, user)
         if check_msg:
             return check_msg
         exchange = parameters["exchange"]
         description = parameters.get("exchange_desc", None)
         coins = parameters.get("coins", 0)
-        check_msg = self.check_trade(t, user)
-        if check_msg:
-            return check_msg
-        with db.atomic():
+        with db.atomic() as txn:
+            if not t.revision:
+                # Claim the trade with a conditional update so that concurrent buyers cannot both get it.
+                claimed = (
+                    Trade.update(status=TradeStatus.SOLD)
+                    .where(Trade.id == t.id, Trade.status == TradeStatus.LAUNCHED, Trade.deleted == False)
+                    .execute()
+                )
+                if not claimed:
+                    return f"⚠️ 交易当前未上架."
+                t.status = TradeStatus.SOLD
+            if coins:
+                # Debit only while the balance still covers the price, otherwise the claim is rolled back too.
+                paid = User.update(coins=User.coins - coins).where(User.id == user.id, User.coins >= coins).execute()
+                if not paid:
+                    txn.rollback()
+                    return "⚠️ 硬币不足."
+                user.coins -= coins
+                adjust_user(t.user, coins=coins)
             e = Exchange.create(user=user, trade=t, exchange=exchange, description=description, coins=coins)
-            log = Log.create(initiator=user, activity="join exchange on trade", details=str(t.id))
-            log.participants.add(t.user)
+            self.add_log(user, "join exchange on trade", str(t.id), [t.user])
             logger.debug(f"{user.name} 参与了 {t.user.name} 发起的交易.")
+        self.evict_trade(t)
         if not t.revision:
             await self.to_menu(
                 self.bot,
@@ -1137,16 +1760,17 @@ class Bot(metaclass=Singleton):
                 to_trade=True,
             )
             with db.atomic():
+                Exchange.update(status=ExchangeStatus.ACCEPTED).where(Exchange.id == e.id).execute()
                 e.status = ExchangeStatus.ACCEPTED
-                e.save()
-                t.status = TradeStatus.SOLD
-                t.save()
-                e.user.sanity = min(e.user.sanity + max(sqrt(max(t.coins, 10)) / 20, 3), 100)
-                e.user.save()
-                t.user.sanity = min(t.user.sanity + max(sqrt(max(t.coins, 10)) / 5, 5), 100)
-                t.user.save()
-                log = Log.create(initiator=user, activity="buy trade", details=str(e.id))
-                log.participants.add(t.user)
+                coins_root = sqrt(max(t.coins, 10))
+                User.update(sanity=fn.MIN(User.sanity + int(max(coins_root / 20, 3)), 100)).where(
+                    User.id == e.user_id
+                ).execute()
+                User.update(sanity=fn.MIN(User.sanity + int(max(coins_root / 5, 5)), 100)).where(
+                    User.id == t.user_id
+                ).execute()
+                self.add_log(user, "buy trade", str(e.id), [t.user])
+            self.evict_trade(t, e)
             await self.to_menu(
                 self.bot, context, "__trade_finished", trade_id=t.id, exchange_id=e.id, to_trade=False
             )
@@ -1163,7 +1787,7 @@ class Bot(metaclass=Singleton):
 
     @useroper("community")
     async def on_report(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
         if user_has_field(t.user, "admin_trade"):
             await context.answer("⚠️ 无法举报管理员.")
             return
@@ -1171,28 +1795,28 @@ class Bot(metaclass=Singleton):
             await context.answer("⚠️ 您的信誉值低于70或低于对方, 无法举报.")
             return
         with db.atomic():
-            d = Dispute.get_or_none(user=user, trade=t, type=DisputeType.VIOLATION)
+            d = (
+                Dispute.select(Dispute.id, Dispute.influence)
+                .where(Dispute.user == user, Dispute.trade == t, Dispute.type == DisputeType.VIOLATION)
+                .first()
+            )
             if not d:
-                Dispute.create(user=user, trade=t, type=DisputeType.VIOLATION, influence=10)
-                t.user.sanity = max(t.user.sanity - 10, 0)
-                t.user.save()
-                log = Log.create(initiator=user, activity="report on a trade", details=str(t.id))
-                log.participants.add(t.user)
+                Dispute.insert(user=user, trade=t, type=DisputeType.VIOLATION, influence=10).execute()
+                adjust_user(t.user, sanity=-10)
+                self.add_log(user, "report on a trade", str(t.id), [t.user])
                 logger.debug(f"{user.name} 举报了 {t.user.name} 发起的交易.")
-                await context.answer("✅ 成功举报.")
             else:
-                d.trade.user.sanity = min(d.trade.user.sanity + d.influence, 100)
-                d.trade.user.save()
+                adjust_user(t.user, sanity=d.influence)
                 d.delete_instance()
-                log = Log.create(initiator=user, activity="cancel report on a trade", details=str(t.id))
-                log.participants.add(t.user)
+                self.add_log(user, "cancel report on a trade", str(t.id), [t.user])
                 logger.debug(f"{user.name} 取消举报了 {t.user.name} 发起的交易.")
-                await context.answer("✅ 成功取消举报.")
+        self.evict_trade(t)
+        await context.answer("✅ 成功取消举报." if d else "✅ 成功举报.")
         await self.to_menu(client, context, "trade_details")
 
     @useroper("community")
     async def on_contact(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         if not t.user.chat:
             await context.answer("⚠️ 对方禁用了在线联系.")
             return
@@ -1207,27 +1831,10 @@ class Bot(metaclass=Singleton):
         if user.sanity < 60:
             await context.answer("⚠️ 信誉过低, 已被封禁.")
             return
-        if (
-            Trade.select()
-            .where(Trade.status == TradeStatus.LAUNCHED, Trade.deleted == False)
-            .join(User)
-            .where(User.id == user.id)
-            .count()
-            > 5
-        ):
+        if over_launch_limit(user):
             await context.answer("⚠️ 不能上架超过 5 个交易.")
             return
-        return dedent(
-            """
-        🌈 欢迎在 **易物** 置换平台发起交易, 规则如下:
-        1. 禁止发送政治/暴力/虐待/儿童色情/赌博/毒品/非法交易等置换. (永封)
-        2. 禁止将色情图片作为物品描述图. (7天)
-        3. 当您上架的物品出现虚假/货不对板, 并被交换者举报, 我们将扣除您的信用分 (当前为 {sanity}), 低于 90 的信用分将导致您被检查, 低于 70 的信用分将导致您被封禁.
-        4. 在商品描述中加入图片/链接可能需要等待管理员检查才可上架.
-        """.format(
-                sanity=user.sanity
-            )
-        ).strip()
+        return _NEW_TRADE_GUIDE.format(sanity=user.sanity)
 
     @useroper()
     async def on_new_trade(self, handler, client: Client, context: TC, parameters: dict, user: User):
@@ -1235,7 +1842,7 @@ class Bot(metaclass=Singleton):
         self.set_conversation(user, context, ConversationStatus.WAITING_TRADE_NAME, params=params)
         msg = "👉🏼 请输入您**可供交换的物品**名称 (尽可能简短):"
         if parameters.get("trade_modify", False):
-            t = Trade.get_by_id(int(parameters["trade_id"]))
+            t = self.get_trade(int(parameters["trade_id"]))
             msg += f"\n🔄 (当前: `{t.name}`)"
         await context.answer()
         await client.send_message(user.uid, msg)
@@ -1247,13 +1854,14 @@ class Bot(metaclass=Singleton):
             trade_revision = True
         else:
             trade_revision = False
+        now = datetime.now()
         if parameters["trade_start_time"]:
             available = datetime.fromtimestamp(int(parameters["trade_start_time"]))
         else:
-            available = datetime.now()
+            available = now
         if parameters.get("trade_modify", False):
             with db.atomic():
-                t = Trade.get_by_id(int(parameters["trade_id"]))
+                t = get_trade_with_user(int(parameters["trade_id"]))
                 t.name = parameters["trade_name"]
                 t.exchange = parameters["trade_exchange_for"]
                 t.coins = parameters["trade_coins"]
@@ -1262,9 +1870,9 @@ class Bot(metaclass=Singleton):
                 t.good = parameters["trade_good"]
                 t.available = available
                 t.revision = trade_revision
-                t.modified = datetime.now()
+                t.modified = now
                 t.save()
-                Log.create(initiator=user, activity="modify a trade", details=str(t.id))
+                self.add_log(user, "modify a trade", str(t.id))
         else:
             with db.atomic():
                 t = Trade.create(
@@ -1278,20 +1886,21 @@ class Bot(metaclass=Singleton):
                     available=available,
                     revision=trade_revision,
                 )
-                Log.create(initiator=user, activity="add a trade", details=str(t.id))
+                self.add_log(user, "add a trade", str(t.id))
         with db.atomic():
             if (not user_has_field(user, "admin_trade")) and self.trade_requires_check(t):
                 t.status = TradeStatus.CHECKING
-                t.save()
-                Log.create(initiator=user, activity="launch a trade", details="requires checking")
+                t.save(only=[Trade.status])
+                self.add_log(user, "launch a trade", "requires checking")
                 logger.debug(f'{user.name} 提交了一个出售 "{t.name}" 的交易待检查.')
                 msg = "🛡️ 等待管理员检查后上架."
             else:
                 t.status = TradeStatus.LAUNCHED
-                t.save()
-                Log.create(initiator=user, activity="launch a trade", details="launched")
+                t.save(only=[Trade.status])
+                self.add_log(user, "launch a trade", "launched")
                 logger.debug(f'{user.name} 上架了一个出售 "{t.name}" 的交易.')
                 msg = "⭐ 成功上架."
+        self.evict_trade(t)
         await client.send_message(user.uid, msg)
 
     @useroper()
@@ -1334,24 +1943,12 @@ class Bot(metaclass=Singleton):
 
     @useroper()
     async def on_trade_details_mine(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        if t.status == TradeStatus.PENDING:
-            status = "**未发布**"
-        elif t.status == TradeStatus.CHECKING:
-            status = "正在检查**待上架**"
-        elif t.status == TradeStatus.LAUNCHED:
-            if t.available and t.available > datetime.now():
-                status = f"已上架并在**未来**开放购买"
-            else:
-                status = f"**已上架**"
-        elif t.status == TradeStatus.SOLD:
-            status = "交易成功"
-        elif t.status == TradeStatus.TIMEDOUT:
-            status = "因**过久未更新**被下架"
-        elif t.status == TradeStatus.DISPUTED:
-            status = "正处于**纠纷锁定**状态"
-        elif t.status == TradeStatus.VIOLATION:
-            status = "因**违反用户协议**被移除"
+        t = self.get_trade(int(parameters["trade_id"]))
+        now = datetime.now()
+        if t.status == TradeStatus.LAUNCHED and t.available and t.available > now:
+            status = "已上架并在**未来**开放购买"
+        else:
+            status = _MINE_STATUS_MSG[t.status]
         if t.deleted:
             status += " (已删除)"
         msgs = [f"物品名称: **{t.name}**"]
@@ -1370,22 +1967,22 @@ class Bot(metaclass=Singleton):
             msgs += [f"\n意向交换:\n{t.exchange}"]
         else:
             msgs += [f"意向交换: {t.exchange}"]
-        if t.available > datetime.now():
+        if t.available > now:
             msgs.append(f"可用时间: {t.available.strftime('%Y-%m-%d %H:%M:%S')}")
-        msg = f"ℹ️ 您的交易 ({status})\n\n" + indent("\n".join(msgs), " " * 3)
+        msg = f"ℹ️ 您的交易 ({status})\n\n" + indent("\n".join(msgs), _INDENT)
         exchanges = (
-            Exchange.select()
-            .where(Exchange.status == ExchangeStatus.LAUNCHED)
-            .join(Trade)
-            .where(Trade.id == t.id)
+            Exchange.select(Exchange, User)
+            .join(User)
+            .where(Exchange.status == ExchangeStatus.LAUNCHED, Exchange.trade == t.id)
         )
-        if exchanges.count():
-            msg += "\n\n📩 交换请求:\n\n"
-            for e in exchanges.iterator():
-                msg += f"   - {user_spec(e.user)}"
-                if e.description:
-                    msg += f": {truncate_str(e.description, 15)}"
-                msg += "\n"
+        requests = []
+        for e in exchanges.iterator():
+            if e.description:
+                requests.append(f"   - {user_spec(e.user)}: {truncate_str(e.description, 15)}\n")
+            else:
+                requests.append(f"   - {user_spec(e.user)}\n")
+        if requests:
+            msg += "\n\n📩 交换请求:\n\n" + "".join(requests)
         if t.photo:
             return InputMediaPhoto(media=t.photo, caption=msg)
         else:
@@ -1397,17 +1994,14 @@ class Bot(metaclass=Singleton):
     def trade_requires_check(self, trade):
         if trade.photo:
             return True
-        url_pattern = re.compile(
-            r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
-        )
-        if any(url_pattern.search(f) for f in (trade.name, trade.description, trade.exchange) if f):
+        if contains_url(trade.name, trade.description, trade.exchange):
             return True
         if trade.user.sanity < 90:
             return True
 
     @useroper()
     async def on_share(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         tu = user_spec(t.user)
         td = f"🌈以下是将被分享的商品海报:\n\n🛍️ __{tu}__ 正在请求以物易物:\n\n"
         tl = f"t.me/{client.me.username}?start=__t_{t.id}"
@@ -1434,7 +2028,7 @@ class Bot(metaclass=Singleton):
 
     @useroper()
     async def on_launch(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
         if t.status >= TradeStatus.SOLD or t.deleted:
             await context.answer("⚠️ 交易关闭无法上架.")
             return
@@ -1442,62 +2036,58 @@ class Bot(metaclass=Singleton):
             if not user_has_field(user, "add_trade"):
                 await context.answer("⚠️ 没有权限.")
                 return
-            if (
-                Trade.select()
-                .where(Trade.status == TradeStatus.LAUNCHED, Trade.deleted == False)
-                .join(User)
-                .where(User.id == user.id)
-                .count()
-                > 5
-            ):
+            if over_launch_limit(user):
                 await context.answer("⚠️ 不能上架超过 5 个交易.")
                 return
             with db.atomic():
                 if (not user_has_field(user, "admin_trade")) and self.trade_requires_check(t):
                     t.status = TradeStatus.CHECKING
-                    Log.create(initiator=user, activity="launch a trade", details="requires checking")
+                    self.add_log(user, "launch a trade", "requires checking")
                     logger.debug(f'{user.name} 提交了一个出售 "{t.name}" 的交易待检查.')
-                    await context.answer("🛡️ 等待管理员检查后上架.")
+                    notice = "🛡️ 等待管理员检查后上架."
                 else:
                     t.status = TradeStatus.LAUNCHED
-                    Log.create(initiator=user, activity="launch a trade", details="launched")
+                    self.add_log(user, "launch a trade", "launched")
                     logger.debug(f'{user.name} 上架了一个出售 "{t.name}" 的交易.')
-                    await context.answer("✅ 成功上架.")
-                t.save()
+                    notice = "✅ 成功上架."
+                t.save(only=[Trade.status])
+            self.evict_trade(t)
+            await context.answer(notice)
             await self.to_menu(client, context, "__trade_mine")
         else:
             with db.atomic():
                 t.status = TradeStatus.PENDING
-                t.save()
-                Log.create(initiator=user, activity="unlaunch a trade", details=str(t.id))
-                await context.answer("✅ 成功下架.")
-                await self.to_menu(client, context, "__trade_mine")
+                t.save(only=[Trade.status])
+                self.add_log(user, "unlaunch a trade", str(t.id))
+            self.evict_trade(t)
+            await context.answer("✅ 成功下架.")
+            await self.to_menu(client, context, "__trade_mine")
 
     @useroper()
     async def on_delete(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
         if t.deleted:
             await context.answer("⚠️ 交易已经被删除.")
             return
         if t.status >= TradeStatus.DISPUTED:
             await context.answer("⚠️ 无法删除争议交易.")
             return
-        if Dispute.select().join(Trade).where(Trade.id == t.id).count():
+        disputed = fn.EXISTS(Dispute.select(Dispute.id).where(Dispute.trade == t.id))
+        if not Trade.update(deleted=True).where(Trade.id == t.id, ~disputed).execute():
             await context.answer("⚠️ 无法删除争议交易.")
             return
-        with db.atomic():
-            t.deleted = True
-            t.save()
-            Log.create(initiator=user, activity="delete a trade", details=str(t.id))
-            await context.answer("✅ 成功删除.")
-            await self.to_menu(client, context, "trade_list")
+        t.deleted = True
+        self.evict_trade(t)
+        self.add_log(user, "delete a trade", str(t.id))
+        await context.answer("✅ 成功删除.")
+        await self.to_menu(client, context, "trade_list")
 
     @useroper()
     async def on_modify(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         if t.status >= TradeStatus.SOLD or t.deleted:
             await context.answer("⚠️ 交易关闭无法修改.")
-        elif Dispute.select().join(Trade).where(Trade.id == t.id).count():
+        elif Dispute.select().where(Dispute.trade == t.id).exists():
             await context.answer("⚠️ 无法修改争议交易.")
         else:
             await self.to_menu(client, context, "new_trade", trade_modify=True)
@@ -1508,26 +2098,35 @@ class Bot(metaclass=Singleton):
 
     @useroper("admin")
     async def on_sys_admin(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        latest_user_r: User = User.select().where(User.uid != "0").order_by(User.created.desc()).get()
-        trades = Trade.select().where(Trade.status > TradeStatus.PENDING, Trade.deleted == False)
-        latest_activity_r = User.select().where(User.uid != "0").order_by(User.activity.desc()).get()
-        latest_log_r: Log = Log.select().order_by(Log.created.desc()).get()
+        users = User.select(User.uid, User.name).where(User.uid != "0")
+        counts = (
+            Trade.select(
+                User.select(fn.COUNT(User.id)).alias("users"),
+                fn.COUNT(Trade.id).alias("trades"),
+            )
+            .where(Trade.status > TradeStatus.PENDING, Trade.deleted == False)
+            .tuples()
+        )
+        latest_log = Log.select(Log.activity, User.uid, User.name).join(User).order_by(Log.created.desc())
+        (users_count, trades_count), latest_user_r, latest_activity_r, latest_log_r = await asyncio.gather(
+            db_thread(counts.get),
+            db_thread(users.order_by(User.created.desc()).get),
+            db_thread(users.order_by(User.activity.desc()).get),
+            db_thread(latest_log.get),
+        )
         latest_log_user = latest_log_r.initiator
         if latest_log_user.uid == "0":
             latest_log_spec = f"**{latest_log_user.name}**: {latest_log_r.activity}"
         else:
-            latest_log_spec = f"[{latest_log_r.initiator.name}](tg://user?id={latest_log_r.initiator.uid}): {latest_log_r.activity}"
-        msg = f"⭐ 当前系统信息:\n\n" + indent(
-            "\n".join(
-                [
-                    f"有效用户: {User.select().count()}",
-                    f"最新用户: [{latest_user_r.name}](tg://user?id={latest_user_r.uid})",
-                    f"最近访问: [{latest_activity_r.name}](tg://user?id={latest_activity_r.uid})",
-                    f"总交易数: {trades.count()}",
-                    f"最新日志: {latest_log_spec}",
-                ]
-            ),
-            " " * 3,
+            latest_log_spec = (
+                f"[{latest_log_user.name}](tg://user?id={latest_log_user.uid}): {latest_log_r.activity}"
+            )
+        msg = _SYS_INFO_TMPL.format(
+            users_count=users_count,
+            latest_user=latest_user_r,
+            latest_activity=latest_activity_r,
+            trades_count=trades_count,
+            latest_log=latest_log_spec,
         )
         return msg
 
@@ -1544,10 +2143,10 @@ class Bot(metaclass=Singleton):
         user_ids = parameters.get("user_ids", None)
         cond = parameters.get("cond", None)
         urs = (
-            User.select(User, fn.Count(Field.id).alias("fields_count"))
-            .join(User.levels.get_through_model(), JOIN.LEFT_OUTER)
+            User.select(User.id, User.uid, User.name, fn.Count(Field.id).alias("fields_count"))
+            .join(UserUserLevel, JOIN.LEFT_OUTER)
             .join(UserLevel, JOIN.LEFT_OUTER)
-            .join(UserLevel.fields.get_through_model(), JOIN.LEFT_OUTER)
+            .join(UserLevelField, JOIN.LEFT_OUTER)
             .join(Field, JOIN.LEFT_OUTER)
         )
         if user_ids:
@@ -1560,15 +2159,15 @@ class Bot(metaclass=Singleton):
         urs = urs.where(User.uid != "0").order_by(SQL("fields_count")).group_by(User)
 
         items = []
-        admin_ids = []
+        admin_ids = set()
         count = 0
-        for ur in admins.iterator():
+        for ur in admins.namedtuples().iterator():
             count += 1
-            admin_ids.append(ur.id)
+            admin_ids.add(ur.id)
             items.append(
                 (f"`{count: >3}` | [{ur.name}](tg://user?id={ur.uid}) (**Admin**)", str(count), ur.uid)
             )
-        for ur in urs.iterator():
+        for ur in urs.namedtuples().iterator():
             if ur.id not in admin_ids:
                 count += 1
                 items.append((f"`{count: >3}` | [{ur.name}](tg://user?id={ur.uid})", str(count), ur.uid))
@@ -1586,50 +2185,36 @@ class Bot(metaclass=Singleton):
         if not ur:
             return "⚠️ 用户未注册"
 
-        trades = ur.trades.where(Trade.status > TradeStatus.PENDING, Trade.deleted == False).count()
-        trade_disputes = ur.trades.where(Trade.status >= TradeStatus.DISPUTED).count()
-        trade_sold = ur.trades.where(Trade.status == TradeStatus.SOLD).count()
-        exchanges = ur.exchanges.count()
-        exchanges_disputes = ur.exchanges.where(Exchange.status >= ExchangeStatus.DISPUTED).count()
-        exchanges_accepted = ur.exchanges.where(Exchange.status == ExchangeStatus.ACCEPTED).count()
-        last_active_time = ur.activity.strftime("%Y-%m-%d")
-        msg = "ℹ️ 用户信息如下\n\n" + indent(
-            "\n".join(
-                [
-                    f"用户 ID: `{uid}`",
-                    f"用户昵称: [{ur.name}](tg://user?id={ur.uid})",
-                    f"角色信用: {ur.sanity}",
-                    f"角色硬币: {ur.coins}",
-                    f"交易总数: {trades}",
-                    f"交易成功: {trade_sold}",
-                    f"交易争议: {trade_disputes}",
-                    f"交换总数: {exchanges}",
-                    f"交换成功: {exchanges_accepted}",
-                    f"交换争议: {exchanges_disputes}",
-                    f"最近活跃: {last_active_time}",
-                    f"用户组: {', '.join([l.name for l in ur.levels])}",
-                ]
-            ),
-            " " * 3,
+        now = datetime.now()
+        ts, es, restrictions = await asyncio.gather(
+            db_thread(user_trade_stats, ur),
+            db_thread(user_exchange_stats, ur),
+            db_thread(user_restrictions, ur, now),
         )
-
-        if ur.restrictions.count():
-            msg += "\n\n🚨 封禁历史记录\n\n"
-            for r in ur.restrictions.order_by(Restriction.to.desc()).iterator():
-                if r.to > datetime.now():
-                    msg += f"   - By {r.by.name} ({r.created.strftime('%Y-%m-%d')}) to **{r.to.strftime('%Y-%m-%d')}**)\n"
-                    for f in r.fields:
-                        msg += f"     封禁: {f.name}\n"
+        msg = _USER_DETAILS_TMPL.format(uid=uid, user=ur, ts=ts, es=es, levels=user_level_names(ur))
+        if restrictions:
+            lines = ["\n\n🚨 封禁历史记录\n\n"]
+            for r, fields in restrictions:
+                if r.to > now:
+                    lines.append(
+                        f"   - By {r.by.name} ({r.created.strftime('%Y-%m-%d')}) to **{r.to.strftime('%Y-%m-%d')}**)\n"
+                    )
+                    for f in fields:
+                        lines.append(f"     封禁: {f}\n")
                 else:
-                    msg += f"   - By {r.by.name} ~~({r.created.strftime('%Y-%m-%d')}, {(r.to - r.created).days} days)~~\n"
+                    lines.append(
+                        f"   - By {r.by.name} ~~({r.created.strftime('%Y-%m-%d')}, {(r.to - r.created).days} days)~~\n"
+                    )
+            msg += "".join(lines)
         return msg
 
     @useroper("admin_user")
     async def content_user_level(self, handler, client: Client, context: TC, parameters: dict, user: User):
         ur = User.get(uid=int(parameters["user_id"]))
         items = []
-        for i, ulr in enumerate(ur.levels):
-            items.append((f"`{i+1: >3}` | {ulr.name} ({ulr.fields.count()} 个权限)", str(i + 1), ulr.id))
+        user_levels = UserUserLevel.select(UserUserLevel.userlevel).where(UserUserLevel.user == ur)
+        for i, ulr in enumerate(levels_with_field_count(UserLevel.id.in_(user_levels))):
+            items.append((f"`{i+1: >3}` | {ulr.name} ({ulr.field_count} 个权限)", str(i + 1), ulr.id))
         return items
 
     @useroper("admin_user")
@@ -1648,11 +2233,11 @@ class Bot(metaclass=Singleton):
                 return
         with db.atomic():
             ur.levels.remove(lr)
-            log = Log.create(initiator=user, activity="remove level from user", details=str(lr.id))
-            log.participants.add(ur)
+            invalidate_user_field(ur)
+            self.add_log(user, "remove level from user", str(lr.id), [ur])
             logger.debug(f"{user.name} 设置 {ur.name} 减少了 {lr.name} 等级.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "user")
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "user")
 
     @useroper("admin_user")
     async def content_user_level_add(
@@ -1660,11 +2245,15 @@ class Bot(metaclass=Singleton):
     ):
         ur = User.get(uid=int(parameters["user_id"]))
         items = []
-        for i, ulr in enumerate(UserLevel.select().iterator()):
-            if Field.get(name="all") in ulr.fields:
+        super_levels = UserLevelField.select(UserLevelField.userlevel).join(Field).where(Field.name == "all")
+        super_levels = {lid for lid, in super_levels.tuples()}
+        user_levels = UserUserLevel.select(UserUserLevel.userlevel).where(UserUserLevel.user == ur)
+        user_levels = {lid for lid, in user_levels.tuples()}
+        for i, ulr in enumerate(levels_with_field_count().iterator()):
+            if ulr.id in super_levels:
                 continue
-            if ulr not in ur.levels:
-                items.append((f"`{i+1: >3}` | {ulr.name} ({ulr.fields.count()} 个权限)", str(i + 1), ulr.id))
+            if ulr.id not in user_levels:
+                items.append((f"`{i+1: >3}` | {ulr.name} ({ulr.field_count} 个权限)", str(i + 1), ulr.id))
         if not items:
             await context.answer("⚠️ 用户已经隶属于目前所有可用用户组.")
             return
@@ -1683,27 +2272,21 @@ class Bot(metaclass=Singleton):
         if user_has_field(ur, "admin"):
             require_admin_admin = False
         else:
-            for f in lr.fields:
-                if f.name == "admin":
-                    require_admin_admin = True
-                    break
-            else:
-                require_admin_admin = False
+            require_admin_admin = lr.fields.where(Field.name == "admin").exists()
         if require_admin_admin:
             if not user_has_field(user, "admin_admin"):
                 await context.answer("⚠️ 无权限设置管理员相关设置.")
                 return
+        if UserUserLevel.select().where(UserUserLevel.user == ur, UserUserLevel.userlevel == lr).exists():
+            await context.answer("⚠️ 用户组已存在.")
+            return
         with db.atomic():
-            if not lr in ur.levels:
-                ur.levels.add(lr)
-            else:
-                await context.answer("⚠️ 用户组已存在.")
-                return
-            log = Log.create(initiator=user, activity="add level to user", details=str(lr.id))
-            log.participants.add(ur)
+            ur.levels.add(lr)
+            invalidate_user_field(ur)
+            self.add_log(user, "add level to user", str(lr.id), [ur])
             logger.debug(f"{user.name} 设置 {ur.name} 增加了 {lr.name} 等级.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "user")
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "user")
 
     @useroper("admin_user")
     async def on_user_delete(self, handler, client: Client, context: TC, parameters: dict, user: User):
@@ -1726,12 +2309,12 @@ class Bot(metaclass=Singleton):
         ur = User.get(uid=int(parameters["user_id"]))
         with db.atomic():
             r = Restriction.create(user=ur, by=user, to=datetime(9999, 12, 31))
-            r.fields.add(Field.get(name="all"))
-            log = Log.create(initiator=user, activity="ban user")
-            log.participants.add(ur)
+            r.fields.add(field_by_name("all"))
+            invalidate_user_field(ur)
+            self.add_log(user, "ban user", participants=[ur])
             logger.debug(f"{user.name} 封禁了 {ur.name}.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "user")
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "user")
 
     @useroper("admin_user")
     async def content_restriction_fields(
@@ -1748,7 +2331,7 @@ class Bot(metaclass=Singleton):
             await context.answer("⚠️ 请先去除其管理员权限.")
             return
         items = []
-        for i, fr in enumerate(Field.select().join(UserLevel.fields.get_through_model()).iterator()):
+        for i, fr in enumerate(assigned_fields().iterator()):
             items.append((f"`{i+1: >3}` | {fr.name}", str(i + 1), fr.id))
         return items
 
@@ -1757,30 +2340,31 @@ class Bot(metaclass=Singleton):
         self, handler, client: Client, context: TC, parameters: dict, user: User
     ):
         if "fields" in parameters:
-            return f"**当前选择: {','.join([Field.get_by_id(fid).name for fid in parameters['fields']])}**"
+            fids = parameters["fields"]
+            names = dict(Field.select(Field.id, Field.name).where(Field.id.in_(fids)).tuples())
+            return f"**当前选择: {','.join(names[fid] for fid in fids)}**"
         else:
             return ""
 
     @useroper("admin_user")
     async def on_user_restriction(self, handler, client: Client, context: TC, parameters: dict, user: User):
         ur = User.get(uid=int(parameters["user_id"]))
-        frs = [Field.get_by_id(fid) for fid in parameters.pop("fields")]
+        frs = [field_by_id(fid) for fid in parameters.pop("fields")]
         time = int(parameters["user_restriction_time_id"])
         with db.atomic():
             r = Restriction.create(user=ur, by=user, to=datetime.now() + timedelta(days=time))
-            for fr in frs:
-                r.fields.add(fr)
-            log = Log.create(initiator=user, activity="restrict user", details=str(r.id))
-            log.participants.add(ur)
+            r.fields.add(frs)
+            invalidate_user_field(ur)
+            self.add_log(user, "restrict user", str(r.id), [ur])
             logger.debug(f"{user.name} 对 {ur.name} 执行了 {time} 天的限制.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "user")
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "user")
 
     @useroper("admin_user")
     async def on_user_restriction_get(
         self, handler, client: Client, context: TC, parameters: dict, user: User
     ):
-        fr = Field.get_by_id(int(parameters["user_restriction_get_id"]))
+        fr = field_by_id(int(parameters["user_restriction_get_id"]))
         if not "fields" in parameters:
             parameters["fields"] = [fr.id]
         else:
@@ -1802,18 +2386,19 @@ class Bot(metaclass=Singleton):
         self, handler, client: Client, context: TC, parameters: dict, user: User
     ):
         ur = User.get(uid=int(parameters["user_id"]))
-        rs = Restriction.select().where(Restriction.to > datetime.now()).join(User).where(User.id == ur.id)
-        if not rs.count():
+        now = datetime.now()
+        active = Restriction.select(Restriction.id).where(Restriction.user == ur, Restriction.to > now)
+        rids = [rid for rid, in active.tuples()]
+        if not rids:
             await context.answer("⚠️ 用户未被限制.")
             return
         with db.atomic():
-            for r in rs:
-                r.to = datetime.now()
-                r.save()
-                log = Log.create(initiator=user, activity="remove restriction from user", details=str(r.id))
-                log.participants.add(ur)
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "user")
+            Restriction.update(to=now).where(Restriction.id.in_(rids)).execute()
+            for rid in rids:
+                self.add_log(user, "remove restriction from user", str(rid), [ur])
+            invalidate_user_field(ur)
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "user")
 
     @useroper("admin_message")
     async def on_user_message(self, handler, client: Client, context: TC, parameters: dict, user: User):
@@ -1823,31 +2408,33 @@ class Bot(metaclass=Singleton):
     @useroper("admin_admin")
     async def content_level_admin(self, handler, client: Client, context: TC, parameters: dict, user: User):
         items = []
-        for i, ulr in enumerate(UserLevel.select().iterator()):
-            items.append((f"`{i+1: >3}` | {ulr.name} ({ulr.fields.count()} 个权限)", str(i + 1), ulr.id))
+        for i, ulr in enumerate(levels_with_field_count().iterator()):
+            items.append((f"`{i+1: >3}` | {ulr.name} ({ulr.field_count} 个权限)", str(i + 1), ulr.id))
         return items
 
     @useroper("admin_admin")
     async def content_level_field(self, handler, client: Client, context: TC, parameters: dict, user: User):
         lr = UserLevel.get_by_id(int(parameters["level_id"]))
         items = []
-        for i, fr in enumerate(lr.fields):
+        for i, fr in enumerate(lr.fields.select(Field.id, Field.name).namedtuples()):
             items.append((f"`{i+1: >3}` | {fr.name}", str(i + 1), fr.id))
         return items
 
     @useroper("admin_admin")
     async def on_level_field_delete(self, handler, client: Client, context: TC, parameters: dict, user: User):
         lr = UserLevel.get_by_id(int(parameters["level_id"]))
-        fr = Field.get_by_id(int(parameters["user_level_field_id"]))
+        fr = field_by_id(int(parameters["user_level_field_id"]))
         if fr.name == "all":
             await context.answer("⚠️ 无法删除超级管理员权限.")
             return
         with db.atomic():
             lr.fields.remove(fr)
-            Log.create(initiator=user, activity="delete field from level", details=f"{lr.id}, {fr.id}")
+            invalidate_user_field()
+            invalidate_fields()
+            self.add_log(user, "delete field from level", f"{lr.id}, {fr.id}")
             logger.debug(f"{user.name} 从 {lr.name} 等级删除了 {fr.name} 权限.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "level")
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "level")
 
     @useroper("admin_admin")
     async def content_level_field_add(
@@ -1856,7 +2443,7 @@ class Bot(metaclass=Singleton):
         lr = UserLevel.get_by_id(int(parameters["level_id"]))
         self.set_conversation(user, context, ConversationStatus.WAITING_FIELD, level=lr)
         items = []
-        for i, fr in enumerate(Field.select().join(UserLevel.fields.get_through_model()).iterator()):
+        for i, fr in enumerate(assigned_fields().iterator()):
             items.append((f"`{i+1: >3}` | {fr.name}", str(i + 1), fr.id))
         return items
 
@@ -1865,21 +2452,25 @@ class Bot(metaclass=Singleton):
         self, handler, client: Client, context: Union[TC, TM], parameters: dict, user: User
     ):
         lr = UserLevel.get_by_id(int(parameters["level_id"]))
-        fr = Field.get_by_id(int(parameters["level_field_add_id"]))
+        fr = field_by_id(int(parameters["level_field_add_id"]))
         if fr.name == "all":
             if not user_has_field(user, "all"):
                 context.answer("⚠️ 超级管理员才能增加超级管理员权限.")
                 return
-        with db.atomic():
-            lr.fields.add(fr)
-            Log.create(initiator=user, activity="add field to level", details=f"{lr.id}, {fr.id}")
-            logger.debug(f"{user.name} 向 {lr.name} 等级增加了 {fr.name} 权限.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "level")
+        assigned = UserLevelField.select().where(UserLevelField.userlevel == lr, UserLevelField.field == fr)
+        if not assigned.exists():
+            with db.atomic():
+                lr.fields.add(fr)
+                invalidate_user_field()
+                invalidate_fields()
+                self.add_log(user, "add field to level", f"{lr.id}, {fr.id}")
+                logger.debug(f"{user.name} 向 {lr.name} 等级增加了 {fr.name} 权限.")
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "level")
 
     @useroper("admin_trade")
     async def on_checked(self, handler, client: Client, context: Union[TC, TM], parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
         if t.deleted:
             await context.answer("⚠️ 无法检查已经删除的物品.")
             return
@@ -1888,36 +2479,37 @@ class Bot(metaclass=Singleton):
             return
         with db.atomic():
             t.status = TradeStatus.LAUNCHED
-            t.save()
-            log = Log.create(initiator=user, activity="check trade", details=str(t.id))
-            log.participants.add(t.user)
+            t.save(only=[Trade.status])
+            self.add_log(user, "check trade", str(t.id), [t.user])
             logger.debug(f'{user.name} 检查了交易 "{truncate_str(t.name, 20)}"')
-            await client.send_message(
-                t.user.uid, f"📢 管理员通知: 您的交易 **{t.name}** 已被管理员审核上架.", parse_mode=ParseMode.MARKDOWN
-            )
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "trade_details")
+        self.evict_trade(t)
+        await client.send_message(
+            t.user.uid,
+            f"📢 管理员通知: 您的交易 **{t.name}** 已被管理员审核上架.",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "trade_details")
 
     @useroper("admin_trade")
     async def on_violation(
         self, handler, client: Client, context: Union[TC, TM], parameters: dict, user: User
     ):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
         with db.atomic():
             t.status = TradeStatus.VIOLATION
-            t.save()
-            t.user.sanity -= 30
-            t.user.save()
-            log = Log.create(initiator=user, activity="set trade as violation", details=str(t.id))
-            log.participants.add(t.user)
+            t.save(only=[Trade.status])
+            adjust_user(t.user, sanity=-30)
+            self.add_log(user, "set trade as violation", str(t.id), [t.user])
             logger.debug(f"{user.name} 认定了一个交易为违规.")
-            await client.send_message(
-                t.user.uid,
-                f"📢 管理员提醒: 您出售的 **{t.name}** 的因违规被管理员锁定, 您将被扣除一定信誉.",
-                parse_mode=ParseMode.MARKDOWN,
-            )
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "trade_details")
+        self.evict_trade(t)
+        await client.send_message(
+            t.user.uid,
+            f"📢 管理员提醒: 您出售的 **{t.name}** 的因违规被管理员锁定, 您将被扣除一定信誉.",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        await context.answer("✅ 成功")
+        await self.to_menu(client, context, "trade_details")
 
     @useroper("admin_trade")
     async def content_report_admin(
@@ -1925,7 +2517,7 @@ class Bot(metaclass=Singleton):
     ):
         if isinstance(context, TC):
             await context.edit_message_media((InputMediaPhoto(self._logo)))
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         if t.status >= TradeStatus.DISPUTED:
             try:
                 await context.answer("⚠️ 该交易已经处于举报解决状态.")
@@ -1934,25 +2526,18 @@ class Bot(metaclass=Singleton):
             await self.to_menu(client, context, "__trade_admin")
             return
         items = []
-        icons = {
-            DisputeType.TRADE_NO_GOOD: "🔍",
-            DisputeType.TRADE_NOT_AS_DESCRIPTION: "😞",
-            DisputeType.EXCHANGE_NO_GOOD: "🔍",
-            DisputeType.EXCHANGE_NOT_AS_DESCRIPTION: "😞",
-            DisputeType.VIOLATION: "🚫",
-        }
-        typespec = {
-            DisputeType.TRADE_NO_GOOD: "出售者发送虚假物品",
-            DisputeType.TRADE_NOT_AS_DESCRIPTION: "出售者发送物品与描述不符",
-            DisputeType.EXCHANGE_NO_GOOD: "交换者发送虚假物品",
-            DisputeType.EXCHANGE_NOT_AS_DESCRIPTION: "交换者发送物品与描述不符",
-            DisputeType.VIOLATION: "违规内容",
-        }
-        for i, dr in enumerate(t.disputes.order_by(Dispute.created).iterator()):
+        disputes = (
+            Dispute.select(Dispute.id, Dispute.type, Dispute.description, User.name.alias("user_name"))
+            .join(User)
+            .where(Dispute.trade == t.id)
+            .order_by(Dispute.created)
+            .namedtuples()
+        )
+        for i, dr in enumerate(disputes.iterator()):
             if dr.description:
-                spec = f"{icons[dr.type]} `{i+1}` | 举报{typespec[dr.type]}: {truncate_str(dr.description, 20)}"
+                spec = f"{_DISPUTE_ICONS[dr.type]} `{i+1}` | 举报{_DISPUTE_TYPESPEC[dr.type]}: {truncate_str(dr.description, 20)}"
             else:
-                spec = f"{icons[dr.type]} `{i+1}` | <来自 __{dr.user.name}__ 的举报: {typespec[dr.type]}>"
+                spec = f"{_DISPUTE_ICONS[dr.type]} `{i+1}` | <来自 __{dr.user_name}__ 的举报: {_DISPUTE_TYPESPEC[dr.type]}>"
             items.append((spec, str(i + 1), dr.id))
         if not items:
             try:
@@ -1965,18 +2550,12 @@ class Bot(metaclass=Singleton):
 
     @useroper()
     async def on_report_details(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        dr = Dispute.get_by_id(int(parameters["report_details_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
+        dr = get_dispute_with_user(int(parameters["report_details_id"]))
         msg = f"🚨 举报 {dr.type.name}\n\n"
         msg += f"交易: {truncate_str(t.name, 10)}\n   => {truncate_str(t.exchange, 10)}\n"
         if t.status in (TradeStatus.SOLD, TradeStatus.DISPUTED):
-            e = (
-                Exchange.select()
-                .where(Exchange.status == ExchangeStatus.ACCEPTED)
-                .join(Trade)
-                .where(Trade.id == t.id)
-                .get()
-            )
+            e = accepted_exchange(t)
             if t.user == dr.user:
                 reportee = e.user
                 reportee_provides = t.exchange
@@ -1997,208 +2576,197 @@ class Bot(metaclass=Singleton):
 
     @useroper()
     async def on_report_accept(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        dr = Dispute.get_by_id(int(parameters["report_details_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
+        dr = get_dispute_with_user(int(parameters["report_details_id"]))
         with db.atomic():
+            e = None
             if dr.type == DisputeType.VIOLATION:
                 t.status = TradeStatus.VIOLATION
-                dr.user.coins += dr.influence / 2 * 100
-                dr.user.sanity = min(dr.user.sanity + dr.influence / 2, 100)
-                t.user.sanity = max(t.user.sanity - dr.influence * 2, 0)
-                await client.send_message(
-                    dr.user.uid,
-                    f"📢 管理员提醒: 您对 __{user_spec(t.user)}__ 出售 **{t.name}** 的违规举报被管理员审核通过, 您将被奖励一定的硬币和信誉.",
-                    parse_mode=ParseMode.MARKDOWN,
-                )
-                await client.send_message(
-                    t.user.uid,
-                    f"📢 管理员提醒: 您出售的 **{t.name}** 的因违规被管理员锁定, 您将被扣除一定信誉.",
-                    parse_mode=ParseMode.MARKDOWN,
-                )
+                reporter = dr.user
+                reportee = t.user
+                adjust_user(reporter, sanity=dr.influence / 2, coins=dr.influence / 2 * 100)
+                adjust_user(reportee, sanity=-dr.influence * 2)
+                notices = [
+                    (
+                        dr.user.uid,
+                        f"📢 管理员提醒: 您对 __{user_spec(t.user)}__ 出售 **{t.name}** 的违规举报被管理员审核通过, 您将被奖励一定的硬币和信誉.",
+                    ),
+                    (t.user.uid, f"📢 管理员提醒: 您出售的 **{t.name}** 的因违规被管理员锁定, 您将被扣除一定信誉."),
+                ]
             else:
                 t.status = TradeStatus.DISPUTED
-                e = (
-                    Exchange.select()
-                    .where(Exchange.status == ExchangeStatus.ACCEPTED)
-                    .join(Trade)
-                    .where(Trade.id == t.id)
-                    .group_by(Exchange)
-                    .get()
-                )
+                e = accepted_exchange(t)
                 if dr.type in (DisputeType.EXCHANGE_NO_GOOD, DisputeType.EXCHANGE_NOT_AS_DESCRIPTION):
                     reporter = t.user
                     reportee = e.user
                 elif dr.type in (DisputeType.TRADE_NO_GOOD, DisputeType.TRADE_NOT_AS_DESCRIPTION):
                     reporter = e.user
                     reportee = t.user
-                reporter.coins += t.coins / 2
-                reportee.sanity = max(reportee.sanity - dr.influence - 10, 0)
-                reportee.coins -= t.coins / 2
-                await client.send_message(
-                    reporter.uid, f"📢 管理员提醒: 您对交易的违规举报被管理员审核通过, 您将被补偿一定的硬币.", parse_mode=ParseMode.MARKDOWN
-                )
-                await client.send_message(
-                    reportee.uid, f"📢 管理员提醒: 您的交易存在违规被举报, 您将被扣除一定的信誉.", parse_mode=ParseMode.MARKDOWN
-                )
-            reporter.save()
-            reportee.save()
-            t.save()
-            log = Log.create(initiator=user, activity="accept report", details=str(dr.id))
-            log.participants.add(dr.user)
+                adjust_user(reporter, coins=t.coins / 2)
+                adjust_user(reportee, sanity=-dr.influence - 10, coins=-t.coins / 2)
+                notices = [
+                    (reporter.uid, f"📢 管理员提醒: 您对交易的违规举报被管理员审核通过, 您将被补偿一定的硬币."),
+                    (reportee.uid, f"📢 管理员提醒: 您的交易存在违规被举报, 您将被扣除一定的信誉."),
+                ]
+            t.save(only=[Trade.status])
+            self.add_log(user, "accept report", str(dr.id), [dr.user])
             logger.debug(f"{user.name} 确认了一个交易为违规.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "trade_details")
+        self.evict_trade(t, e)
+        await asyncio.gather(
+            *(client.send_message(uid, text, parse_mode=ParseMode.MARKDOWN) for uid, text in notices),
+            context.answer("✅ 成功"),
+        )
+        await self.to_menu(client, context, "trade_details")
 
     @useroper()
     async def on_report_decline(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        dr = Dispute.get_by_id(int(parameters["report_details_id"]))
+        t = get_trade_with_user(int(parameters["trade_id"]))
+        dr = get_dispute_with_user(int(parameters["report_details_id"]))
         with db.atomic():
+            e = None
             if dr.type == DisputeType.VIOLATION:
                 dr_sanity_old = int(dr.user.sanity)
-                dr.user.sanity = max(dr.user.sanity - dr.influence / 2, 0)
-                dr.user.save()
+                adjust_user(dr.user, sanity=-dr.influence / 2)
                 reportee = t.user
                 msg = f"📢 管理员警告: 您对 __{user_spec(t.user)}__ 出售 **{t.name}** 的违规举报被管理员拒绝. 您已被扣除 {int(dr_sanity_old-dr.user.sanity)} 信誉. 请勿恶意举报."
-                await client.send_message(dr.user.uid, msg, parse_mode=ParseMode.MARKDOWN)
             else:
-                e = (
-                    Exchange.select()
-                    .where(Exchange.status == ExchangeStatus.ACCEPTED)
-                    .join(Trade)
-                    .where(Trade.id == t.id)
-                    .group_by(Exchange)
-                    .get()
-                )
+                e = accepted_exchange(t)
                 if dr.type in (DisputeType.EXCHANGE_NO_GOOD, DisputeType.EXCHANGE_NOT_AS_DESCRIPTION):
                     reportee = e.user
                 elif dr.type in (DisputeType.TRADE_NO_GOOD, DisputeType.TRADE_NOT_AS_DESCRIPTION):
                     reportee = t.user
                 msg = f"📢 管理员警告: 您对交易的违规举报被管理员拒绝. 如您对此有疑问, 请再次发起举报."
-                await client.send_message(dr.user.uid, msg, parse_mode=ParseMode.MARKDOWN)
-            reportee.sanity = min(reportee.sanity + dr.influence, 100)
-            reportee.save()
+            adjust_user(reportee, sanity=dr.influence)
             dr.delete_instance()
-            log = Log.create(initiator=user, activity="accept report", details=str(dr.id))
-            log.participants.add(dr.user)
+            self.add_log(user, "accept report", str(dr.id), [dr.user])
             logger.debug(f"{user.name} 否认了一个交易为违规.")
-            await context.answer("✅ 成功")
-            await self.to_menu(client, context, "report_admin")
+        self.evict_trade(t, e)
+        await asyncio.gather(
+            client.send_message(dr.user.uid, msg, parse_mode=ParseMode.MARKDOWN), context.answer("✅ 成功")
+        )
+        await self.to_menu(client, context, "report_admin")
 
     @useroper()
     async def on_trade_notify(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        e = Exchange.get_by_id(int(parameters["exchange_id"]))
-        msg = "🙋‍♂️ 新的交易请求\n\n"
-        msg += f"对方 ({user_spec(e.user)}) 提供了您需要的:\n**{t.exchange}**\n"
-        if e.description:
-            msg += f"{e.description}\n"
-        else:
-            msg += f"对方没有提供物品描述.\n"
-        msg += f"\n您需要确认交易以查看内容, 若您点击确认交易, 您的 **{truncate_str(t.name, 10)}** 将被提供给对方.\n"
-        return msg
+        t = self.get_trade(int(parameters["trade_id"]))
+        e = self.get_exchange(int(parameters["exchange_id"]))
+        return _TRADE_NOTIFY_TMPL.format(
+            owner=user_spec(e.user),
+            exchange=t.exchange,
+            description=e.description or "对方没有提供物品描述.",
+            name=truncate_str(t.name, 10),
+        )
 
     @useroper()
     async def on_trade_accept(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        e = Exchange.get_by_id(int(parameters["exchange_id"]))
-        if t.status != TradeStatus.LAUNCHED or e.status != ExchangeStatus.LAUNCHED:
-            await context.answer("⚠️ 该交易不再可用.")
-            await context.message.delete()
+        t, e = await self._open_exchange(context, parameters)
+        if not e:
             return
-        with db.atomic():
+        with db.atomic() as txn:
+            # Accept only while both rows are still open, so that a concurrent accept or buyer cannot be overwritten.
+            accepted = (
+                Exchange.update(status=ExchangeStatus.ACCEPTED)
+                .where(Exchange.id == e.id, Exchange.status == ExchangeStatus.LAUNCHED)
+                .execute()
+            )
+            sold = accepted and (
+                Trade.update(status=TradeStatus.SOLD)
+                .where(Trade.id == t.id, Trade.status == TradeStatus.LAUNCHED)
+                .execute()
+            )
+            if not sold:
+                txn.rollback()
+                return "⚠️ 该交易不再可用."
             e.status = ExchangeStatus.ACCEPTED
-            e.save()
             t.status = TradeStatus.SOLD
-            t.save()
-            e.user.sanity = min(e.user.sanity + max(sqrt(max(t.coins, 10)) / 20, 3), 100)
-            t.user.sanity = min(t.user.sanity + max(sqrt(max(t.coins, 10)) / 5, 5), 100)
-            t.user.save()
-            e.user.save()
-            log = Log.create(initiator=user, activity="accept exchange", details=str(e.id))
-            log.participants.add(e.user)
-        await self.to_menu(
-            self.bot,
-            menu_id="__trade_finished",
-            uid=e.user.uid,
-            trade_id=t.id,
-            exchange_id=e.id,
-            to_trade=False,
-        )
-        await self.to_menu(
-            self.bot, context, "__trade_finished", trade_id=t.id, exchange_id=e.id, to_trade=True
+            coins_root = sqrt(max(t.coins, 10))
+            e_sanity = fn.MIN(User.sanity + int(max(coins_root / 20, 3)), 100)
+            t_sanity = fn.MIN(User.sanity + int(max(coins_root / 5, 5)), 100)
+            User.update(sanity=Case(User.id, [(e.user_id, e_sanity), (t.user_id, t_sanity)])).where(
+                User.id.in_([e.user_id, t.user_id])
+            ).execute()
+            self.add_log(user, "accept exchange", str(e.id), [e.user])
+        self.evict_trade(t, e)
+        await asyncio.gather(
+            self.to_menu(
+                self.bot,
+                menu_id="__trade_finished",
+                uid=e.user.uid,
+                trade_id=t.id,
+                exchange_id=e.id,
+                to_trade=False,
+            ),
+            self.to_menu(
+                self.bot, context, "__trade_finished", trade_id=t.id, exchange_id=e.id, to_trade=True
+            ),
         )
 
     @useroper()
     async def on_trade_decline(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        e = Exchange.get_by_id(int(parameters["exchange_id"]))
-        if t.status != TradeStatus.LAUNCHED or e.status != ExchangeStatus.LAUNCHED:
-            await context.answer("⚠️ 该交易不再可用.")
-            await context.message.delete()
+        t, e = await self._open_exchange(context, parameters)
+        if not e:
             return
         with db.atomic():
             e.status = ExchangeStatus.DECLINED
-            e.save()
-            log = Log.create(initiator=user, activity="decline exchange", details=str(e.id))
-            log.participants.add(e.user)
-            msg = f"😥 很遗憾, 交易 **{t.exchange}** => **{t.name}** 被对方拒绝.\n\n您的**{t.exchange}**:\n||{e.exchange}||\n依然可用."
-            await self.bot.send_message(e.user.uid, msg, parse_mode=ParseMode.MARKDOWN)
-            await context.answer("✅ 已拒绝.")
-        await asyncio.sleep(0.5)
-        await context.message.delete()
+            e.save(only=[Exchange.status])
+            self.add_log(user, "decline exchange", str(e.id), [e.user])
+        self.evict_trade(t, e)
+        msg = f"😥 很遗憾, 交易 **{t.exchange}** => **{t.name}** 被对方拒绝.\n\n您的**{t.exchange}**:\n||{e.exchange}||\n依然可用."
+        await asyncio.gather(
+            self.bot.send_message(e.user.uid, msg, parse_mode=ParseMode.MARKDOWN),
+            context.answer("✅ 已拒绝."),
+        )
+        self.delete_later(context.message)
 
     @useroper()
     async def on_trade_blacklist(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        e = Exchange.get_by_id(int(parameters["exchange_id"]))
-        if t.status != TradeStatus.LAUNCHED or e.status != ExchangeStatus.LAUNCHED:
-            await self.answer("⚠️ 该交易不再可用.")
-            await context.message.delete()
+        t, e = await self._open_exchange(context, parameters)
+        if not e:
             return
         with db.atomic():
             e.status = ExchangeStatus.DECLINED
-            e.save()
-            log = Log.create(initiator=user, activity="decline exchange", details=str(e.id))
-            log.participants.add(e.user)
-            msg = f"😥 很遗憾, 交换 {t.exchange} => {t.name} 被对方拒绝, 同时您已被拉黑.\n\n您的物品:\n||{e.exchange}||\n依然可用."
+            e.save(only=[Exchange.status])
             BlackList.create(by=t.user, of=e.user)
-            await self.bot.send_message(e.user.uid, msg, parse_mode=ParseMode.MARKDOWN)
-            await context.answer("✅ 已拒绝并拉黑.")
-        await asyncio.sleep(0.5)
-        await context.message.delete()
+            self.add_log(user, "decline exchange", str(e.id), [e.user])
+        self.evict_trade(t, e)
+        msg = f"😥 很遗憾, 交换 {t.exchange} => {t.name} 被对方拒绝, 同时您已被拉黑.\n\n您的物品:\n||{e.exchange}||\n依然可用."
+        await asyncio.gather(
+            self.bot.send_message(e.user.uid, msg, parse_mode=ParseMode.MARKDOWN),
+            context.answer("✅ 已拒绝并拉黑."),
+        )
+        self.delete_later(context.message)
 
     @useroper()
     async def on_trade_finish(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
-        e = Exchange.get_by_id(int(parameters["exchange_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
+        e = self.get_exchange(int(parameters["exchange_id"]))
         to_trade = parameters.get("to_trade", True)
-        msg = "🌈 交易完成\n\n"
+        msgs = ["🌈 交易完成\n\n"]
         if to_trade:
-            msg += f"您的交易已完成, 您已向对方提供了:\n**{t.name}**\n||{t.good}||\n\n"
+            msgs.append(f"您的交易已完成, 您已向对方提供了:\n**{t.name}**\n||{t.good}||\n\n")
             if e.coins:
-                msg += f"对方向您支付了 {e.coins} 硬币.\n"
+                msgs.append(f"对方向您支付了 {e.coins} 硬币.\n")
             else:
-                msg += f"对方 ({user_spec(e.user)}) 提供了您需要的:\n**{t.exchange}**\n"
+                msgs.append(f"对方 ({user_spec(e.user)}) 提供了您需要的:\n**{t.exchange}**\n")
                 if e.description:
-                    msg += f"{e.description}\n"
-                msg += f"||{e.exchange}||\n\n"
+                    msgs.append(f"{e.description}\n")
+                msgs.append(f"||{e.exchange}||\n\n")
         else:
             if e.coins:
-                msg += f"您的交易已完成, 您已向对方支付了 {e.coins} 硬币.\n"
+                msgs.append(f"您的交易已完成, 您已向对方支付了 {e.coins} 硬币.\n")
             else:
-                msg += f"您的交易已完成, 您已向对方提供了:\n**{t.exchange}**\n"
+                msgs.append(f"您的交易已完成, 您已向对方提供了:\n**{t.exchange}**\n")
                 if e.description:
-                    msg += f"{e.description}\n"
-                msg += f"||{e.exchange}||\n\n"
-            msg += f"对方 ({user_spec(t.user)}) 提供了您需要的:\n**{t.name}**\n"
+                    msgs.append(f"{e.description}\n")
+                msgs.append(f"||{e.exchange}||\n\n")
+            msgs.append(f"对方 ({user_spec(t.user)}) 提供了您需要的:\n**{t.name}**\n")
             if t.description:
-                msg += f"{t.description}\n"
-            msg += f"||{t.good}||\n\n"
-        msg += f"请注意: 该信息将**只显示一次**, 请及时保存所需信息.\n"
-        msg += f"若您对该交易有疑虑, 可以在 7 天内举报.\n"
-        msg += f"欢迎您再次使用 **易物 Exchanger**!"
-        return msg
+                msgs.append(f"{t.description}\n")
+            msgs.append(f"||{t.good}||\n\n")
+        msgs.append(f"请注意: 该信息将**只显示一次**, 请及时保存所需信息.\n")
+        msgs.append(f"若您对该交易有疑虑, 可以在 7 天内举报.\n")
+        msgs.append(f"欢迎您再次使用 **易物 Exchanger**!")
+        return "".join(msgs)
 
     @useroper()
     async def on_trade_report(self, handler, client: Client, context: TC, parameters: dict, user: User):
@@ -2207,34 +2775,27 @@ class Bot(metaclass=Singleton):
 
     @useroper()
     async def on_user_me(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        trades = user.trades.where(Trade.status > TradeStatus.PENDING, Trade.deleted == False).count()
-        trade_sold = user.trades.where(Trade.status == TradeStatus.SOLD).count()
-        exchanges = user.exchanges.count()
-        exchanges_accepted = user.exchanges.where(Exchange.status == ExchangeStatus.ACCEPTED).count()
-        msg = "ℹ️ 当前用户信息\n\n" + indent(
-            "\n".join(
-                [
-                    f"ID: `{user.uid}`",
-                    f"昵称: [{user.name}](tg://user?id={user.uid})",
-                    f"信用: {user.sanity}",
-                    f"硬币: {user.coins}",
-                    f"交易成功: {trade_sold} / {trades}",
-                    f"交换成功: {exchanges_accepted} / {exchanges}",
-                    f"用户组: {', '.join([l.name for l in user.levels])}",
-                ]
-            ),
-            " " * 3,
+        now = datetime.now()
+        ts, es, restrictions = await asyncio.gather(
+            db_thread(user_trade_stats, user),
+            db_thread(user_exchange_stats, user),
+            db_thread(user_restrictions, user, now),
         )
-
-        if user.restrictions.count():
-            msg += "\n\n🚨 封禁\n\n"
-            for r in user.restrictions.order_by(Restriction.to.desc()).iterator():
-                if r.to > datetime.now():
-                    msg += f"   - By {r.by.name} ({r.created.strftime('%Y-%m-%d')} to **{r.to.strftime('%Y-%m-%d')}**)\n"
-                    for f in r.fields:
-                        msg += f"     封禁: {f.name}\n"
+        msg = _USER_ME_TMPL.format(user=user, ts=ts, es=es, levels=user_level_names(user))
+        if restrictions:
+            lines = ["\n\n🚨 封禁\n\n"]
+            for r, fields in restrictions:
+                if r.to > now:
+                    lines.append(
+                        f"   - By {r.by.name} ({r.created.strftime('%Y-%m-%d')} to **{r.to.strftime('%Y-%m-%d')}**)\n"
+                    )
+                    for f in fields:
+                        lines.append(f"     封禁: {f}\n")
                 else:
-                    msg += f"   - By {r.by.name} ~~({r.created.strftime('%Y-%m-%d')}, {(r.to - r.created).days} days)~~\n"
+                    lines.append(
+                        f"   - By {r.by.name} ~~({r.created.strftime('%Y-%m-%d')}, {(r.to - r.created).days} days)~~\n"
+                    )
+            msg += "".join(lines)
         return msg
 
     @useroper()
@@ -2245,7 +2806,7 @@ class Bot(metaclass=Singleton):
         else:
             user.chat = True
             await context.answer("✅ 允许与您私聊.")
-        user.save()
+        user.save(only=[User.chat])
         await self.to_menu(client, context, "user_me")
 
     @useroper()
@@ -2256,17 +2817,29 @@ class Bot(metaclass=Singleton):
         else:
             user.anonymous = True
             await context.answer("✅ 开启匿名模式.")
-        user.save()
+        user.save(only=[User.anonymous])
         await self.to_menu(client, context, "user_me")
 
     @useroper()
     async def content_trade_exchange_list(
         self, handler, client: Client, context: TC, parameters: dict, user: User
     ):
-        t = Trade.get_by_id(int(parameters["trade_id"]))
+        t = self.get_trade(int(parameters["trade_id"]))
         items = []
         for i, er in enumerate(
-            Exchange.select().join(Trade).where(Trade.id == t.id).order_by(Exchange.status).iterator()
+            Exchange.select(
+                Exchange.id,
+                Exchange.description,
+                Exchange.status,
+                User.id,
+                User.uid,
+                User.name,
+                User.anonymous,
+            )
+            .join(User)
+            .where(Exchange.trade == t.id)
+            .order_by(Exchange.status)
+            .iterator()
         ):
             if er.description:
                 spec = f"`{i+1: >3}` | {truncate_str(er.description, 20)}"
@@ -2282,7 +2855,7 @@ class Bot(metaclass=Singleton):
 
     @useroper()
     async def on_trade_exchange(self, handler, client: Client, context: TC, parameters: dict, user: User):
-        e = Exchange.get_by_id(int(parameters["trade_exchange_id"]))
+        e = self.get_exchange(int(parameters["trade_exchange_id"]))
         if e.status == ExchangeStatus.DECLINED:
             await context.answer(f"⚠️ 来自 {user_spec(e.user)} 的请求已关闭.")
             return
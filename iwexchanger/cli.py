@@ -2,8 +2,6 @@ import asyncio
 import logging
 from pathlib import Path
 
-import uvloop
-import toml
 import typer
 from appdirs import user_data_dir
 from loguru import logger
@@ -13,7 +11,11 @@ from rich.theme import Theme
 from peewee import ManyToManyField
 
 traceback.install()
-uvloop.install()
+
+try:
+    import rtoml as toml
+except ImportError:
+    import toml
 
 from . import __author__, __name__, __url__, __version__
 
@@ -36,8 +38,13 @@ app = typer.Typer(
     context_settings={"help_option_names": ["-h", "--help"]},
 )
 
-from .bot import Bot
-from .model import BaseModel, User, UserLevel, Field, Log, db
+DB_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": 1,
+    "cache_size": -64000,
+    "temp_store": "memory",
+    "mmap_size": 268435456,
+}
 
 
 @app.command(help=f"Bot server for [orange3]IW Exchanger[/] {__version__}.")
@@ -50,6 +57,16 @@ def main(
         help="Config toml file",
     )
 ):
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        uvloop.install()
+
+    from .bot import Bot
+    from .model import BaseModel, User, UserLevel, Field, Log, db
+
     with open(config) as f:
         config = toml.load(f)
     proxy = config.get("proxy", None)
@@ -60,47 +77,50 @@ def main(
 
     db_path = Path(config.get("db", "{data}/iwexchanger.db").format(data=user_data_dir(__name__)))
     db_path.parent.mkdir(parents=True, exist_ok=True)
-    if not db_path.exists():
-        models = []
-        for m in BaseModel.__subclasses__():
-            models.append(m)
-        for m in BaseModel.__subclasses__():
-            for n, f in m._meta.manytomany.items():
-                if isinstance(f, ManyToManyField):
-                    models.append(f.get_through_model())
-        db.init(db_path)
+    models = BaseModel.__subclasses__()
+    models += [
+        f.get_through_model() for m in models for f in m._meta.manytomany.values() if isinstance(f, ManyToManyField)
+    ]
+    created = not db_path.exists()
+    db.init(db_path, pragmas=DB_PRAGMAS)
+    if created:
         db.create_tables(models)
-        system = User.create(uid="0", name="System")
-        system_l = UserLevel.create(name="system")
-        all_f = Field.create(name="all")
-        system_l.fields.add(all_f)
-        system.levels.add(system_l)
-        for names in (
-            "admin",
-            "admin_user",
-            "admin_message",
-            "admin_admin",
-            "admin_field",
-            "admin_restriction",
-            "admin_banner",
-            "admin_trade",
-            "admin_log",
-            "admin_check",
-            "admin_dispute",
-            "view_trades",
-            "add_trade",
-            "exchange",
-            "community",
-        ):
-            field = Field.create(name=names)
-            Log.create(initiator=system, activity="add field", details=str(field.id))
-        user_l = UserLevel.create(name="user")
-        for names in ("view_trades", "add_trade", "exchange", "community"):
-            fr = Field.get(name=names)
-            user_l.fields.add(fr)
-            Log.create(initiator=system, activity="add field to level", details=f"{system_l.id}, {fr.id}")
+        with db.atomic():
+            system = User.create(uid="0", name="System")
+            system_l = UserLevel.create(name="system")
+            all_f = Field.create(name="all")
+            system_l.fields.add(all_f)
+            system.levels.add(system_l)
+            field_names = (
+                "admin",
+                "admin_user",
+                "admin_message",
+                "admin_admin",
+                "admin_field",
+                "admin_restriction",
+                "admin_banner",
+                "admin_trade",
+                "admin_log",
+                "admin_check",
+                "admin_dispute",
+                "view_trades",
+                "add_trade",
+                "exchange",
+                "community",
+            )
+            Field.insert_many([{"name": n} for n in field_names]).execute()
+            fields = {f.name: f for f in Field.select().where(Field.name.in_(field_names))}
+            user_l = UserLevel.create(name="user")
+            user_fields = [fields[n] for n in ("view_trades", "add_trade", "exchange", "community")]
+            user_l.fields.add(user_fields)
+            logs = [{"initiator": system, "activity": "add field", "details": str(fields[n].id)} for n in field_names]
+            logs += [
+                {"initiator": system, "activity": "add field to level", "details": f"{system_l.id}, {fr.id}"}
+                for fr in user_fields
+            ]
+            Log.insert_many(logs).execute()
     else:
-        db.init(db_path)
+        db.create_tables(models, safe=True)
 
     async def doit():
         await Bot(**config["bot"], proxy=proxy).listen()
@@ -4,8 +4,9 @@ from typing import Type
 
 from peewee import *
 from playhouse.postgres_ext import *
+from playhouse.pool import PooledSqliteDatabase
 
-db = SqliteDatabase(None)
+db = PooledSqliteDatabase(None, max_connections=32, stale_timeout=300, check_same_thread=False)
 
 
 class BannerLocation(IntEnum):
@@ -75,8 +76,8 @@ class User(BaseModel):
     levels = ManyToManyField(UserLevel, backref="users")
     coins = IntegerField(default=0)
     sanity = IntegerField(default=100)
-    created = DateTimeField(default=datetime.datetime.now)
-    activity = DateTimeField(default=datetime.datetime.now)
+    created = DateTimeField(default=datetime.datetime.now, index=True)
+    activity = DateTimeField(default=datetime.datetime.now, index=True)
     chat = BooleanField(default=True)
     anonymous = BooleanField(default=False)
 
@@ -86,6 +87,9 @@ class BlackList(BaseModel):
     by = ForeignKeyField(User)
     of = ForeignKeyField(User)
 
+    class Meta:
+        indexes = ((("by", "of"), False),)
+
 
 class Restriction(BaseModel):
     id = AutoField()
@@ -95,6 +99,9 @@ class Restriction(BaseModel):
     to = DateTimeField()
     fields = ManyToManyField(Field)
 
+    class Meta:
+        indexes = ((("user", "to"), False),)
+
 
 class Banner(BaseModel):
     id = AutoField()
@@ -119,10 +126,13 @@ class Trade(BaseModel):
     revision = BooleanField(default=False)
     deleted = BooleanField(default=False)
 
+    class Meta:
+        indexes = ((("status", "deleted"), False),)
+
 
 class Log(BaseModel):
     id = AutoField()
-    created = DateTimeField(default=datetime.datetime.now)
+    created = DateTimeField(default=datetime.datetime.now, index=True)
     initiator = ForeignKeyField(User)
     participants = ManyToManyField(User)
     activity = CharField()
@@ -148,3 +158,6 @@ class Exchange(BaseModel):
     exchange = TextField(null=True)
     coins = IntegerField(default=0)
     description = TextField(null=True)
+
+    class Meta:
+        indexes = ((("trade", "status"), False),)
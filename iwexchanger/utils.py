@@ -1,5 +1,7 @@
 import asyncio
+from collections import OrderedDict
 import functools
+import threading
 from typing import Iterable, Sized, TypeVar
 
 T = TypeVar("T")
@@ -7,10 +9,13 @@ T = TypeVar("T")
 
 class Singleton(type):
     _instances = {}
+    _lock = threading.RLock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+            with Singleton._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
 
@@ -28,25 +33,49 @@ class AsyncCountPool(dict):
             return key
 
 
+class LRUDict(OrderedDict):
+    """A dict that drops its least recently used items when holding more than `maxsize` items."""
+
+    def __init__(self, *args, maxsize=10000, **kw):
+        self.maxsize = maxsize
+        super().__init__(*args, **kw)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            del self[next(iter(self))]
+
+
 def batch(l: Sized, n=1):
     """Make list of list of certain size from a list."""
-    size = len(l)
-    for ndx in range(0, size, n):
-        yield l[ndx : min(ndx + n, size)]
+    for ndx in range(0, len(l), n):
+        yield l[ndx : ndx + n]
 
 
 def remove_prefix(text: str, prefix: str):
-    """Remove prefix from the begining of test."""
-    return text[text.startswith(prefix) and len(prefix) :]
+    """Remove prefix from the begining of test, as `str.removeprefix` does on Python 3.9+."""
+    if prefix and text.startswith(prefix):
+        return text[len(prefix) :]
+    return text
 
 
 def walk(l: Iterable[Iterable]):
     """Iterate over a irregular n-dimensional list."""
-    for el in l:
-        if isinstance(el, Iterable) and not isinstance(el, (str, bytes)):
-            yield from flatten(el)
-        else:
+    stack = [iter(l)]
+    while stack:
+        for el in stack[-1]:
+            if isinstance(el, Iterable) and not isinstance(el, (str, bytes)):
+                stack.append(iter(el))
+                break
             yield el
+        else:
+            stack.pop()
 
 
 def flatten(l: Iterable[Iterable]):
@@ -74,3 +103,9 @@ def async_partial(f, *args1, **kw1):
         return await f(*args1, *args2, **kw1, **kw2)
 
     return func
+
+
+async def to_thread(func, *args, **kw):
+    """Run a blocking function in the default executor, as `asyncio.to_thread` does on Python 3.9+."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kw))